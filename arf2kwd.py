@@ -3,28 +3,155 @@ import argparse
 import os
 from os.path import splitext
 import stat
+import time
+from multiprocessing import Pool
 import numpy as np
+from arf_index import get_index, index_datasets
 
-if __name__=='__main__':
-    p = argparse.ArgumentParser(prog="arf2kwd.py")
-    p.add_argument("arf", help="Arf file to convert to kwd")
-    p.add_argument("-n", "--name", help="in addition to data of types 3, or 23, include channels\
-     containing NAME in their channel name",
-                   default=False)
-    
-    options = p.parse_args()
-    print options.name
-    arffilename = '.'.join([splitext(options.arf)[0], 'raw.kwd'])
-    with h5py.File(arffilename,'w-') as kwd_file:
+# rows per HDF5 chunk are chosen so a chunk spans all channels and is
+# about this many bytes, matching klusta's (time, all channels) reads
+CHUNK_BYTES = 2**20
+# microvolts per kwd sample, the resolution of the Intan amplifiers
+KWD_SCALE = 0.195
+
+
+def extracellular_channels(group, name=False):
+    """returns the datasets of an arf entry that are written to the kwd"""
+    names = index_datasets(get_index(group.file), group.name[1:], (3, 23),
+                           name=name)
+    return [group[dset_name] for dset_name in names]
+
+
+def chunk_rows(nchannels, dset_size, itemsize=2):
+    """number of samples per HDF5 chunk of the kwd data dataset"""
+    rows = max(1, CHUNK_BYTES // (nchannels * itemsize))
+    return int(min(rows, max(dset_size, 1)))
+
+
+def block_rows(nchannels, memory_budget, rows_per_chunk):
+    """number of samples read from all channels at once, a whole number of
+    chunks that fits the memory budget (in bytes).
+    Each block holds the float64 source data and the int16 output."""
+    bytes_per_row = nchannels * (8 + 2)
+    nchunks = max(1, memory_budget // (bytes_per_row * rows_per_chunk))
+    return int(nchunks * rows_per_chunk)
+
+
+def channel_scale(channel):
+    """microvolts per stored sample of an arf channel, given by its 'scale'
+    attribute, 1 (samples in microvolts) if it has none"""
+    return float(channel.attrs.get('scale', 1.))
+
+
+def quantize(channels, start, stop, out=None):
+    """returns samples START:STOP of CHANNELS as an (samples, channels) int16 block"""
+    if out is None:
+        out = np.empty((stop - start, len(channels)), dtype='int16')
+    for ch_idx, channel in enumerate(channels):
+        # convert to microvolts and then to original integer data
+        # (but as *signed* integers).
+        out[:stop - start, ch_idx] = np.round(channel[start:stop]
+                                              * channel_scale(channel)
+                                              / KWD_SCALE)
+    return out[:stop - start]
+
+
+def write_entry(channels, dataset, rows):
+    """copies CHANNELS into the columns of DATASET, ROWS samples at a time.
+    returns the number of bytes written"""
+    dset_size, nchannels = dataset.shape
+    block = np.empty((rows, nchannels), dtype=dataset.dtype)
+    for start in xrange(0, dset_size, rows):
+        stop = min(dset_size, start + rows)
+        dataset[start:stop, :] = quantize(channels, start, stop, block)
+    return dataset.size * dataset.dtype.itemsize
+
+
+def can_link(channels):
+    """True if CHANNELS already hold signed 16 bit samples in kwd units (a
+    'scale' attribute of KWD_SCALE), so the kwd can reference them and
+    holds the same values as a copy"""
+    return (hasattr(h5py, 'VirtualLayout')
+            and all(ch.dtype == np.int16 and ch.ndim == 1
+                    and channel_scale(ch) == KWD_SCALE for ch in channels))
+
+
+def create_virtual_data(kwd_group, channels, source_name):
+    """creates the kwd data dataset as an HDF5 virtual dataset whose
+    columns point at CHANNELS in the arf file SOURCE_NAME"""
+    dset_size = channels[0].size
+    layout = h5py.VirtualLayout(shape=(dset_size, len(channels)), dtype='int16')
+    for ch_idx, channel in enumerate(channels):
+        layout[:, ch_idx] = h5py.VirtualSource(source_name, channel.name,
+                                               shape=(dset_size,))
+    return kwd_group.create_virtual_dataset('data', layout)
+
+
+# each worker process keeps its own read-only handle on the arf file
+_worker_arf = None
+
+
+def _init_worker(arf_name):
+    global _worker_arf
+    _worker_arf = h5py.File(arf_name, 'r')
+
+
+def _read_block(task):
+    idx, channel_names, start, stop = task
+    channels = [_worker_arf[name] for name in channel_names]
+    return idx, start, quantize(channels, start, stop)
+
+
+def write_entries_parallel(arf_name, plan, datasets, jobs):
+    """reads and quantizes blocks of every entry in a pool of JOBS workers,
+    the calling process is the only one writing to DATASETS.
+    PLAN is a list of (channel names, dataset size, block rows) for each entry.
+    returns the number of bytes written"""
+    tasks = [(idx, names, start, min(size, start + rows))
+             for idx, (names, size, rows) in enumerate(plan)
+             for start in xrange(0, size, rows)]
+    pool = Pool(jobs, initializer=_init_worker, initargs=(arf_name,))
+    try:
+        # keep at most 2 blocks per worker in flight to bound memory
+        window = 2 * jobs
+        pending = [pool.apply_async(_read_block, (t,)) for t in tasks[:window]]
+        submitted = len(pending)
+        while pending:
+            idx, start, block = pending.pop(0).get()
+            datasets[idx][start:start + len(block), :] = block
+            if submitted < len(tasks):
+                pending.append(pool.apply_async(_read_block, (tasks[submitted],)))
+                submitted += 1
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return sum(d.size * d.dtype.itemsize for d in datasets)
+
+
+def main(arf_name, name=False, memory=256, jobs=1, virtual=False, verbose=True):
+    kwd_name = '.'.join([splitext(arf_name)[0], 'raw.kwd'])
+    # virtual sources are resolved relative to the kwd, which sits next to the arf
+    source_name = os.path.relpath(arf_name, os.path.dirname(os.path.abspath(kwd_name)))
+    memory_budget = int(memory * 2**20)
+    if jobs > 1:
+        # the budget is shared by all blocks in flight
+        memory_budget //= 2 * jobs
+    nbytes = 0
+    tstart = time.time()
+    with h5py.File(kwd_name, 'w-') as kwd_file:
         kwd_file.create_group('recordings')
-        with h5py.File(options.arf,'r+') as arf_file:
-            groups = (entry for entry in arf_file.itervalues() if isinstance(entry,h5py.Group))
+        with h5py.File(arf_name, 'r') as arf_file:
+            groups = (arf_file[entry] for entry in get_index(arf_file)['entries'])
             nchannels = None
-            for idx,group in enumerate(groups):
-                channels = [dset for dset in group.itervalues()
-                            if dset.attrs.get('datatype') in (3,23)
-                            or (options.name and options.name in dset.name.split('/')[-1])]
-                if nchannels in (len(channels),None):
+            plan = []
+            datasets = []
+            for idx, group in enumerate(groups):
+                channels = extracellular_channels(group, name)
+                if nchannels in (len(channels), None):
                     nchannels = len(channels)
                 else:
                     raise ValueError("The number of extracellular channels must be the same in all arf entries")
@@ -37,20 +164,55 @@ if __name__=='__main__':
                 else:
                     raise ValueError("The number size of each extracellular dataset within each arf entry must be equal")
 
-                for dset in channels:
-                    print(dset.name)
+                if verbose:
+                    for dset in channels:
+                        print(dset.name)
                 kwd_group = kwd_file['recordings'].create_group(str(idx))
-                dataset=kwd_group.create_dataset('data',shape=(dset_size, nchannels),
-                                                 dtype='int16')
-                max_array_size = 10**7 #maximum size of array data to read from disk 
-                for ch_idx,channel in enumerate(channels):
-                    #convert from microvolts to original integer data (but as *signed* integers).
-                    for start in xrange(0,dset_size,max_array_size):
-                        stop = min(dset_size,start+max_array_size)
-                        dataset[start:stop, ch_idx] = np.round(channel[start:stop]/0.195)
+                if virtual and can_link(channels):
+                    create_virtual_data(kwd_group, channels, source_name)
+                else:
+                    if virtual and verbose:
+                        print("{} cannot be linked, copying".format(group.name))
+                    rows_per_chunk = chunk_rows(nchannels, dset_size)
+                    dataset = kwd_group.create_dataset('data', shape=(dset_size, nchannels),
+                                                       dtype='int16',
+                                                       chunks=(rows_per_chunk, nchannels))
+                    rows = block_rows(nchannels, memory_budget, rows_per_chunk)
+                    if jobs > 1:
+                        plan.append(([ch.name for ch in channels], dset_size, rows))
+                        datasets.append(dataset)
+                    else:
+                        nbytes += write_entry(channels, dataset, rows)
 
                 #creating extraneous group and attribute
                 kwd_group.create_group('filter')
                 kwd_group.attrs['downsample_factor'] = np.string_('N.')
 
-    os.chmod(arffilename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if jobs > 1 and plan:
+            nbytes = write_entries_parallel(arf_name, plan, datasets, jobs)
+
+    os.chmod(kwd_name, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    elapsed = time.time() - tstart
+    if verbose:
+        print("wrote {:.1f} MB in {:.1f} s ({:.1f} MB/s)"
+              .format(nbytes / 1e6, elapsed, nbytes / 1e6 / max(elapsed, 1e-9)))
+    return kwd_name
+
+
+if __name__=='__main__':
+    p = argparse.ArgumentParser(prog="arf2kwd.py")
+    p.add_argument("arf", help="Arf file to convert to kwd")
+    p.add_argument("-n", "--name", help="in addition to data of types 3, or 23, include channels\
+     containing NAME in their channel name",
+                   default=False)
+    p.add_argument("-m", "--memory", help="memory budget in MB for each block of samples \
+    read from all channels", default=256, type=float)
+    p.add_argument("-j", "--jobs", help="number of worker processes reading and \
+    converting entries, a single process writes the kwd", default=1, type=int)
+    p.add_argument("--virtual", help="where channels are int16 samples with a 'scale' \
+    attribute of 0.195 (microvolts per sample), create the kwd as virtual datasets \
+    referencing the arf instead of copying the samples",
+                   action="store_true")
+
+    options = p.parse_args()
+    main(options.arf, options.name, options.memory, options.jobs, options.virtual)
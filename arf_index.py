@@ -0,0 +1,167 @@
+from __future__ import division
+import os
+import os.path
+import h5py
+import numpy as np
+from sidecar import load_sidecar, save_sidecar
+
+# indexes of read only files by path, with the (size, mtime) they were
+# built from
+_indexes = {}
+# indexes of files open for writing by path, with the handle they belong to
+_open_indexes = {}
+
+
+def index_filename(arf_name):
+    return os.path.splitext(arf_name)[0] + '.arfindex.npz'
+
+
+def build_index(arf_file):
+    """returns a dictionary of arrays describing the entries of an arf file
+    and their datasets, read in a single walk of the file:
+    'entries' - entry names, sorted
+    'timestamps' - (entries, 2) seconds and microseconds of each entry
+    'entry_lengths' - samples in the first time series of each entry
+    'entry_offsets' - first sample of each entry when the entries are
+        laid end to end, and the total number of samples
+    'dset_entry' - entry number of each dataset, datasets of an entry are
+        contiguous and sorted by name
+    'dset_names' - dataset names, relative to their entry
+    'datatype' - arf datatype of each dataset, -1 if it has none
+    'sampling_rate' - nan if the dataset has none
+    'length' - length of the first dimension, 0 for scalars"""
+    entries = {}
+    datasets = []
+    arf_file.visititems(_visitor(entries, datasets))
+    return assemble_index(entries, datasets)
+
+
+def _visitor(entries, datasets, prefix=''):
+    """visititems callback adding entry timestamps to ENTRIES and dataset
+    records to DATASETS, names are relative to the group PREFIX"""
+    def visit(name, obj):
+        parts = (prefix + name).split('/')
+        if isinstance(obj, h5py.Group) and len(parts) == 1:
+            entries[parts[0]] = obj.attrs.get('timestamp', (0, 0))
+        elif isinstance(obj, h5py.Dataset) and len(parts) == 2:
+            attrs = obj.attrs
+            datasets.append((parts[0], parts[1], attrs.get('datatype', -1),
+                             attrs.get('sampling_rate', np.nan),
+                             obj.shape[0] if obj.shape else 0))
+    return visit
+
+
+def assemble_index(entries, datasets):
+    """the index arrays from a dictionary of entry timestamps and a list of
+    (entry, dataset, datatype, sampling rate, length) records"""
+    names = sorted(entries)
+    datasets = sorted(d for d in datasets if d[0] in entries)
+    entry_number = {name: i for i, name in enumerate(names)}
+    dset_entry = np.array([entry_number[d[0]] for d in datasets], dtype=int)
+    datatype = np.array([d[2] for d in datasets], dtype=int)
+    length = np.array([d[4] for d in datasets], dtype=np.int64)
+    time_series = np.flatnonzero(np.logical_and(datatype >= 0, datatype < 1000))
+    # length of the first time series dataset of each entry
+    entry_lengths = np.zeros(len(names), dtype=np.int64)
+    with_series, first = np.unique(dset_entry[time_series], return_index=True)
+    entry_lengths[with_series] = length[time_series[first]]
+    return {'entries': np.array(names, dtype='U'),
+            'timestamps': np.array([np.ravel(entries[n])[:2] for n in names],
+                                   dtype=np.int64).reshape(-1, 2),
+            'entry_lengths': entry_lengths,
+            'entry_offsets': np.concatenate(([0], np.cumsum(entry_lengths))),
+            'dset_entry': dset_entry,
+            'dset_names': np.array([d[1] for d in datasets], dtype='U'),
+            'datatype': datatype,
+            'sampling_rate': np.array([d[3] for d in datasets], dtype=float),
+            'length': length}
+
+
+def get_index(arf_file, cache=True):
+    """index of an open arf file (see build_index). When the file is open
+    read only, the index is kept in memory and, if CACHE is True, in a
+    file next to the arf; both are rebuilt when the arf has been modified
+    since. For a file open for writing the index is built once per handle,
+    code writing to it calls update_index with the entries it changed."""
+    path = os.path.abspath(arf_file.filename)
+    if arf_file.mode != 'r':
+        handle, index = _open_indexes.get(path, (None, None))
+        if handle is None or not handle.valid or handle != arf_file.id:
+            index = build_index(arf_file)
+            _open_indexes[path] = (arf_file.id, index)
+        return index
+    stat = os.stat(path)
+    stamp = np.array([stat.st_size, stat.st_mtime])
+    if path in _indexes and np.array_equal(_indexes[path][0], stamp):
+        return _indexes[path][1]
+    filename = index_filename(path)
+    index = load_sidecar(filename, stamp) if cache else None
+    if index is None:
+        index = build_index(arf_file)
+        if cache:
+            save_sidecar(filename, stamp, index)
+    _indexes[path] = (stamp, index)
+    return index
+
+
+def update_index(arf_file, entry_names):
+    """walks the entries ENTRY_NAMES of ARF_FILE, a file open for writing,
+    again after they have been created, changed or deleted, and updates its
+    index if it has one"""
+    path = os.path.abspath(arf_file.filename)
+    handle, index = _open_indexes.get(path, (None, None))
+    if handle is None or not handle.valid or handle != arf_file.id:
+        return  # built from the file when it is next needed
+    changed = set(entry_names)
+    entries = {name: timestamp for name, timestamp
+               in zip(index['entries'], index['timestamps'])
+               if name not in changed}
+    datasets = [(index['entries'][e], name, datatype, rate, length)
+                for e, name, datatype, rate, length
+                in zip(index['dset_entry'], index['dset_names'],
+                       index['datatype'], index['sampling_rate'],
+                       index['length'])
+                if index['entries'][e] not in changed]
+    for name in changed:
+        if name in arf_file:
+            entries[name] = arf_file[name].attrs.get('timestamp', (0, 0))
+            arf_file[name].visititems(_visitor(entries, datasets,
+                                               name + '/'))
+    _open_indexes[path] = (arf_file.id, assemble_index(entries, datasets))
+
+
+def index_entry_slice(index, entry_name):
+    """slice of the dataset arrays holding the datasets of ENTRY_NAME"""
+    i = np.flatnonzero(index['entries'] == entry_name)
+    if not len(i):
+        return slice(0, 0)
+    lo, hi = np.searchsorted(index['dset_entry'], [i[0], i[0] + 1])
+    return slice(lo, hi)
+
+
+def index_datasets(index, entry_name, datatypes=None, time_series=False,
+                   name=None):
+    """names of the datasets of ENTRY_NAME, sorted. Only datasets with a
+    datatype in DATATYPES, or time series (datatype < 1000) if TIME_SERIES,
+    or, with NAME, whose name contains NAME"""
+    sel = index_entry_slice(index, entry_name)
+    names = index['dset_names'][sel]
+    datatype = index['datatype'][sel]
+    keep = np.ones(len(names), dtype=bool)
+    if datatypes is not None or time_series:
+        keep = np.zeros(len(names), dtype=bool)
+        if datatypes is not None:
+            keep |= np.isin(datatype, datatypes)
+        if time_series:
+            keep |= np.logical_and(datatype >= 0, datatype < 1000)
+    if name:
+        keep |= np.array([name in n for n in names], dtype=bool)
+    return list(names[keep])
+
+
+def index_samplerate(index):
+    """sampling rate of the first time series with one, None if there is none"""
+    time_series = np.logical_and(index['datatype'] >= 0, index['datatype'] < 1000)
+    rates = index['sampling_rate'][time_series]
+    rates = rates[~np.isnan(rates)]
+    return rates[0] if len(rates) else None
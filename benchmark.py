@@ -0,0 +1,471 @@
+#!/usr/bin/python
+from __future__ import division, print_function
+import argparse
+import imp
+import json
+import os
+import os.path
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+import h5py
+import numpy as np
+
+description = '''
+benchmark.py
+
+times spikechef on synthetic recordings and sorting results of increasing
+size, and saves wall time, throughput and peak memory of each run as JSON.
+With --compare, prints the change from an earlier results file.
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLING_RATE = 30000
+WAV_SAMPLING_RATE = 40000
+
+
+# synthetic data
+
+def make_stimuli(directory, nstimuli, duration=0.5, seed=0):
+    """writes NSTIMULI noise wave files of DURATION seconds, returns their
+    names and samples"""
+    import ewave
+    rng = np.random.RandomState(seed)
+    names, stimuli = [], []
+    for i in range(nstimuli):
+        samples = (rng.randn(int(duration * WAV_SAMPLING_RATE)) * 0.2).astype('f4')
+        name = os.path.join(directory, 'stim{}.wav'.format(i))
+        with ewave.open(name, 'w', sampling_rate=WAV_SAMPLING_RATE,
+                        dtype='f') as f:
+            f.write(samples)
+        names.append(name)
+        stimuli.append(samples)
+    return names, stimuli
+
+
+def make_arf(filename, nentries, nchannels, duration, stimuli=(),
+             presentations=0, sampling_rate=SAMPLING_RATE, seed=0):
+    """writes an arf file of NENTRIES entries of DURATION seconds, each with
+    NCHANNELS extracellular channels (datatype 3, microvolts) named A-000...,
+    and, with STIMULI, PRESENTATIONS stimulus copies per entry marked by
+    pulses. returns a label array (start, name) for each entry"""
+    rng = np.random.RandomState(seed)
+    nsamples = int(duration * sampling_rate)
+    copies = [np.interp(np.arange(int(len(s) * sampling_rate / WAV_SAMPLING_RATE))
+                        * WAV_SAMPLING_RATE / sampling_rate,
+                        np.arange(len(s)), s) for s in stimuli]
+    labels = []
+    with h5py.File(filename, 'w') as f:
+        for e in range(nentries):
+            entry = f.create_group('e{:03d}'.format(e))
+            entry.attrs['timestamp'] = np.array([e * int(duration) + 1, 0])
+            for c in range(nchannels):
+                dset = entry.create_dataset('A-{:03d}'.format(c),
+                                            data=rng.randn(nsamples) * 50)
+                dset.attrs['datatype'] = 3
+                dset.attrs['sampling_rate'] = sampling_rate
+            label = np.zeros(presentations if copies else 0,
+                             dtype=[('start', int), ('name', 'S8')])
+            if len(label):
+                pulse = np.zeros(nsamples)
+                copy = rng.randn(nsamples) * 0.01
+                gap = nsamples // presentations
+                label['start'] = np.arange(presentations) * gap + gap // 4
+                which = rng.randint(0, len(copies), presentations)
+                label['name'] = ['stim{}'.format(i) for i in which]
+                for start, i in zip(label['start'], which):
+                    pulse[start:start + 300] = 5
+                    n = min(len(copies[i]), nsamples - start)
+                    copy[start:start + n] += copies[i][:n]
+                for name, data in (('pulse', pulse), ('copy', copy)):
+                    dset = entry.create_dataset(name, data=data)
+                    dset.attrs['datatype'] = 1
+                    dset.attrs['sampling_rate'] = sampling_rate
+            labels.append(label)
+    return labels
+
+
+def make_kwik(base, nshanks, nclusters, nspikes, nchannels, duration,
+              nsamples=32, seed=0):
+    """writes BASE.kwik and BASE.kwx with NSPIKES spikes in NCLUSTERS
+    clusters on each of NSHANKS shanks, in the channel_groups layout"""
+    rng = np.random.RandomState(seed)
+    with h5py.File(base + '.kwik', 'w') as kwik, \
+            h5py.File(base + '.kwx', 'w') as kwx:
+        for s in range(nshanks):
+            shank = kwik.create_group('channel_groups/{}'.format(s))
+            times = np.sort(rng.randint(0, int(duration * SAMPLING_RATE),
+                                        nspikes)).astype('u8')
+            clusters = rng.randint(0, nclusters, nspikes).astype('u4')
+            shank.create_dataset('spikes/time_samples', data=times)
+            shank.create_dataset('spikes/clusters/main', data=clusters)
+            for c in range(nclusters):
+                group = shank.create_group('clusters/main/{}'.format(c))
+                group.attrs['cluster_group'] = c % 4
+            for i, name in enumerate(['Noise', 'MUA', 'Good', 'Unsorted']):
+                group = shank.create_group('cluster_groups/main/{}'.format(i))
+                group.attrs['name'] = name
+            channels = np.arange(s * nchannels, (s + 1) * nchannels)
+            shank.attrs['channel_order'] = channels
+            for j, c in enumerate(channels):
+                group = shank.create_group('channels/{}'.format(c))
+                group.attrs['position'] = np.array([s, j], dtype=float)
+            waves = kwx.create_dataset(
+                'channel_groups/{}/waveforms_filtered'.format(s),
+                shape=(nspikes, nsamples, nchannels), dtype='i2',
+                chunks=(256, nsamples, nchannels))
+            # one template per cluster plus noise
+            templates = rng.randn(nclusters, nsamples, nchannels) * 200
+            for start in range(0, nspikes, 2**14):
+                stop = min(nspikes, start + 2**14)
+                waves[start:stop] = (templates[clusters[start:stop]]
+                                     + rng.randn(stop - start, nsamples,
+                                                 nchannels) * 30)
+            kwx.create_dataset(
+                'channel_groups/{}/features_masks'.format(s),
+                data=rng.randn(nspikes, nchannels * 3, 2).astype('f4'))
+
+
+def make_old_kwik(filename, nshanks, nclusters, nspikes, nchannels,
+                  duration, nsamples=32, seed=0):
+    """writes a kwik file in the shanks layout read by kwik2arf"""
+    rng = np.random.RandomState(seed)
+    spike_dtype = [('cluster', 'u4'), ('cluster_manual', 'u4'),
+                   ('fet', 'f4'), ('mask', 'f4'), ('time', 'u8')]
+    with h5py.File(filename, 'w') as f:
+        for s in range(nshanks):
+            shank = f.create_group('shanks/shank{}'.format(s))
+            spikes = np.zeros(nspikes, dtype=spike_dtype)
+            spikes['time'] = np.sort(rng.randint(0, int(duration * SAMPLING_RATE),
+                                                 nspikes))
+            spikes['cluster'] = rng.randint(0, nclusters, nspikes)
+            spikes['cluster_manual'] = spikes['cluster']
+            shank.create_dataset('spikes', data=spikes)
+            waves = shank.create_dataset('waveforms/waveform_filtered',
+                                         shape=(nspikes, nsamples, nchannels),
+                                         dtype='f4', chunks=True)
+            for start in range(0, nspikes, 2**14):
+                stop = min(nspikes, start + 2**14)
+                waves[start:stop] = rng.randn(stop - start, nsamples, nchannels)
+            shank.create_dataset('clusters', data=np.array(
+                [(i, i % 4) for i in range(nclusters)],
+                dtype=[('cluster', 'u4'), ('group', 'u4')]))
+            shank.create_dataset('groups_of_clusters', data=np.array(
+                [(i, name) for i, name in
+                 enumerate([b'Noise', b'MUA', b'Good', b'Unsorted'])],
+                dtype=[('group', 'u4'), ('name', 'S10')]))
+
+
+# timing
+
+def _measure(queue, func, args, kwargs, quiet):
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    error = None
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        error = repr(e)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, peak * 1024, (peak - base) * 1024, error))
+
+
+def measure(func, args=(), kwargs=None, quiet=True):
+    """runs FUNC in a new process, returns its wall time, the peak resident
+    memory of the process, its growth during the call, and the error
+    raised, if any"""
+    queue = Queue()
+    proc = Process(target=_measure,
+                   args=(queue, func, args, kwargs or {}, quiet))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _prepare(queue, bench, tmp, scale, params):
+    queue.put(bench(tmp, scale, params))
+
+
+def prepare(bench, tmp, scale, params):
+    """generates the input of a benchmark in a separate process, so that
+    the memory it takes is not counted in the peak of the timed process"""
+    queue = Queue()
+    proc = Process(target=_prepare, args=(queue, bench, tmp, scale, params))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def run_label_stim(arf_name, wavenames, labels):
+    label_stim = imp.load_source('label_stim', os.path.join(HERE, 'label_stim'))
+    label_stim.label_stim(arf_name, wavenames, labels, 'pulse', 'copy')
+
+
+def run_envelopes(arf_name, labels, stim_lengths):
+    import dumber_sums
+    with h5py.File(arf_name, 'r') as f:
+        for entry_name, stimuli in zip(sorted(f), labels):
+            entry = f[entry_name]
+            datasets = [entry[x] for x in sorted(entry) if x.startswith('A-')]
+            dumber_sums.stimulus_envelopes(datasets, stimuli, stim_lengths,
+                                           SAMPLING_RATE)
+
+
+def run_add_spikes(kwik_name, out_name, nentries, entry_samples):
+    import arf
+    import kwik2arf
+    with h5py.File(kwik_name, 'r') as kwik_file, \
+            arf.open_file(out_name, 'w') as out:
+        index = kwik2arf.spike_time_index(kwik_file)
+        for e in range(nentries):
+            entry = arf.create_entry(out, 'e{:03d}'.format(e), time.time())
+            kwik2arf.add_spikes(entry, kwik_file, e * entry_samples,
+                                (e + 1) * entry_samples, SAMPLING_RATE, index)
+
+
+def run_add_lfp(arf_name, out_name, nchannels):
+    import arf
+    import kwik2arf
+    with h5py.File(arf_name, 'r') as raw, arf.open_file(out_name, 'w') as out:
+        for name in sorted(raw):
+            entry = arf.create_entry(out, name, raw[name].attrs['timestamp'])
+            kwik2arf.add_lfp(entry, raw[name], nchannels, verbose=False)
+
+
+def run_spike_index(kwik_name):
+    import kwik_utils
+    with h5py.File(kwik_name, 'r') as kwik:
+        for shank in kwik_utils.get_kwik_shanks(kwik):
+            index = kwik_utils.get_spike_index(shank, cache=False)
+            for cluster in index['clusters']:
+                kwik_utils.index_cluster_times(index, cluster)
+
+
+def run_psth(kwik_name, starts):
+    import kwik_utils
+    with h5py.File(kwik_name, 'r') as kwik:
+        for shank in kwik_utils.get_kwik_shanks(kwik):
+            index = kwik_utils.get_spike_index(shank, cache=False)
+            times = [kwik_utils.index_cluster_times(index, c).astype(np.int64)
+                     for c in index['clusters']]
+            kwik_utils.psth_counts([np.sort(t) for t in times], starts,
+                                   SAMPLING_RATE, -0.5, 1.)
+
+
+def run_waveform_stats(kwik_name, kwx_name):
+    import kwik_utils
+    with h5py.File(kwik_name, 'r') as kwik, h5py.File(kwx_name, 'r') as kwx:
+        for shank in kwik_utils.get_kwik_shanks(kwik):
+            kwx_shank = kwx['channel_groups'][shank.name.split('/')[-1]]
+            kwik_utils.cluster_waveform_stats(kwx_shank, shank, cache=False)
+
+
+# benchmarks, each generates its input and returns
+# (function, arguments, amount of work, units of work)
+
+def bench_arf2kwd(tmp, scale, p):
+    import arf2kwd
+    duration = p.duration * scale
+    name = os.path.join(tmp, 'arf2kwd_{}.arf'.format(scale))
+    make_arf(name, p.entries, p.channels, duration)
+    nbytes = p.entries * p.channels * int(duration * SAMPLING_RATE) * 8
+    return arf2kwd.main, (name,), {'verbose': False}, nbytes / 1e6, 'MB'
+
+
+def bench_label_stim(tmp, scale, p):
+    wavenames, stimuli = make_stimuli(tmp, p.stimuli)
+    name = os.path.join(tmp, 'label_stim_{}.arf'.format(scale))
+    presentations = int(p.presentations * scale)
+    make_arf(name, p.entries, 0, p.duration * scale, stimuli, presentations)
+    labels = ['stim{}'.format(i) for i in range(p.stimuli)]
+    return (run_label_stim, (name, wavenames, labels), {},
+            p.entries * presentations, 'presentations')
+
+
+def bench_dumber_sums(tmp, scale, p):
+    wavenames, stimuli = make_stimuli(tmp, p.stimuli)
+    name = os.path.join(tmp, 'dumber_sums_{}.arf'.format(scale))
+    presentations = int(p.presentations * scale)
+    labels = make_arf(name, p.entries, p.channels, p.duration * scale,
+                      stimuli, presentations)
+    stim_lengths = {'stim{}'.format(i): int(len(s) * SAMPLING_RATE
+                                            / WAV_SAMPLING_RATE)
+                    for i, s in enumerate(stimuli)}
+    nbytes = (p.entries * p.channels * int(p.duration * scale * SAMPLING_RATE)
+              * 8)
+    return (run_envelopes, (name, labels, stim_lengths), {}, nbytes / 1e6,
+            'MB')
+
+
+def bench_add_spikes(tmp, scale, p):
+    name = os.path.join(tmp, 'add_spikes_{}.kwik'.format(scale))
+    nspikes = int(p.spikes * scale)
+    duration = p.duration * scale
+    make_old_kwik(name, p.shanks, p.clusters, nspikes, p.channels, duration)
+    out = os.path.join(tmp, 'add_spikes_{}.arf'.format(scale))
+    entry_samples = int(duration * SAMPLING_RATE) // p.entries + 1
+    return (run_add_spikes, (name, out, p.entries, entry_samples), {},
+            p.shanks * nspikes, 'spikes')
+
+
+def bench_add_lfp(tmp, scale, p):
+    duration = p.duration * scale
+    name = os.path.join(tmp, 'add_lfp_{}.arf'.format(scale))
+    make_arf(name, p.entries, p.channels, duration)
+    out = os.path.join(tmp, 'add_lfp_{}_out.arf'.format(scale))
+    nbytes = p.entries * p.channels * int(duration * SAMPLING_RATE) * 8
+    return run_add_lfp, (name, out, p.channels), {}, nbytes / 1e6, 'MB'
+
+
+def _kwik(tmp, scale, p):
+    base = os.path.join(tmp, 'kwik_{}'.format(scale))
+    if not os.path.exists(base + '.kwx'):
+        make_kwik(base, p.shanks, p.clusters, int(p.spikes * scale),
+                  p.channels, p.duration * scale)
+    return base
+
+
+def bench_spike_index(tmp, scale, p):
+    base = _kwik(tmp, scale, p)
+    return (run_spike_index, (base + '.kwik',), {},
+            p.shanks * int(p.spikes * scale), 'spikes')
+
+
+def bench_psth(tmp, scale, p):
+    base = _kwik(tmp, scale, p)
+    rng = np.random.RandomState(0)
+    nsamples = int(p.duration * scale * SAMPLING_RATE)
+    starts = [np.sort(rng.randint(0, nsamples, int(p.presentations * scale)))
+              for i in range(p.stimuli)]
+    return (run_psth, (base + '.kwik', starts), {},
+            p.shanks * int(p.spikes * scale), 'spikes')
+
+
+def bench_waveform_stats(tmp, scale, p):
+    base = _kwik(tmp, scale, p)
+    return (run_waveform_stats, (base + '.kwik', base + '.kwx'), {},
+            p.shanks * int(p.spikes * scale), 'spikes')
+
+
+BENCHMARKS = [('arf2kwd', bench_arf2kwd),
+              ('label_stim', bench_label_stim),
+              ('dumber_sums', bench_dumber_sums),
+              ('kwik2arf.add_spikes', bench_add_spikes),
+              ('kwik2arf.add_lfp', bench_add_lfp),
+              ('kwik_utils.spike_index', bench_spike_index),
+              ('kwik_utils.psth', bench_psth),
+              ('kwik_utils.waveform_stats', bench_waveform_stats)]
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=HERE).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'h5py': h5py.__version__, 'platform': platform.platform()}
+
+
+def run(params, benchmarks, scales, tmp, verbose=False):
+    results = []
+    for name, bench in benchmarks:
+        for scale in scales:
+            func, args, kwargs, work, units = prepare(bench, tmp, scale,
+                                                      params)
+            seconds, peak, increase, error = measure(func, args, kwargs,
+                                                     quiet=not verbose)
+            result = {'benchmark': name, 'scale': scale, 'seconds': seconds,
+                      'peak_rss': peak, 'rss_increase': increase,
+                      'work': work, 'units': units,
+                      'throughput': work / seconds if seconds else None,
+                      'error': error}
+            results.append(result)
+            print('{:26s} x{:<5g} {:8.2f} s {:10.1f} {}/s {:8.1f} MB peak{}'
+                  .format(name, scale, seconds, result['throughput'] or 0,
+                          units, peak / 2.**20,
+                          '  ERROR ' + error if error else ''))
+            sys.stdout.flush()
+    return results
+
+
+def compare(old, new, threshold=1.2):
+    """prints the ratio of new to old run times of each benchmark and scale,
+    flagging those slower by more than THRESHOLD"""
+    before = {(r['benchmark'], r['scale']): r for r in old['results']}
+    print('compared with {} ({})'.format(old.get('commit'), old.get('date')))
+    for r in new['results']:
+        o = before.get((r['benchmark'], r['scale']))
+        if o is None or not o['seconds'] or r['error'] or o['error']:
+            continue
+        ratio = r['seconds'] / o['seconds']
+        print('{:26s} x{:<5g} {:6.2f}x time {:6.2f}x memory{}'
+              .format(r['benchmark'], r['scale'], ratio,
+                      r['peak_rss'] / float(o['peak_rss']),
+                      '  SLOWER' if ratio > threshold else ''))
+
+
+def main():
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('-o', '--out', default='benchmark.json',
+                   help='results file')
+    p.add_argument('--scales', nargs='+', type=float, default=[1, 2, 4],
+                   help='multiples of the base sizes below')
+    p.add_argument('--only', nargs='+', help='benchmarks to run, of: '
+                   + ', '.join(name for name, _ in BENCHMARKS))
+    p.add_argument('--entries', type=int, default=2, help='arf entries')
+    p.add_argument('--channels', type=int, default=16,
+                   help='channels per entry or shank')
+    p.add_argument('--duration', type=float, default=10.,
+                   help='seconds per entry')
+    p.add_argument('--stimuli', type=int, default=4,
+                   help='number of distinct stimuli')
+    p.add_argument('--presentations', type=int, default=10,
+                   help='stimulus presentations per entry')
+    p.add_argument('--shanks', type=int, default=2)
+    p.add_argument('--clusters', type=int, default=20,
+                   help='clusters per shank')
+    p.add_argument('--spikes', type=int, default=100000,
+                   help='spikes per shank')
+    p.add_argument('--keep', help='directory for the synthetic files, \
+    kept after the run; by default a temporary directory is removed')
+    p.add_argument('--compare', help='earlier results file to compare with')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='show the output of the benchmarked functions')
+    args = p.parse_args()
+    benchmarks = [(name, bench) for name, bench in BENCHMARKS
+                  if not args.only or name in args.only]
+    tmp = args.keep or tempfile.mkdtemp(prefix='spikechef_bench')
+    if not os.path.isdir(tmp):
+        os.makedirs(tmp)
+    try:
+        results = run(args, benchmarks, args.scales, tmp, args.verbose)
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmp)
+    report = environment()
+    report['parameters'] = {k: v for k, v in vars(args).items()
+                            if k not in ('out', 'keep', 'compare', 'verbose')}
+    report['results'] = results
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+from __future__ import division, print_function
+import argparse
+import os.path
+from multiprocessing import Pool
+import h5py
+import numpy as np
+from kwik_utils import (get_kwik_shanks, get_spike_times, get_spike_cluster,
+                        get_spike_waveforms, get_cluster_group, add_by_label)
+
+description = '''
+cluster_metrics.py
+
+computes quality metrics for every cluster of every shank of a kwik/kwx pair
+'''
+
+METRICS_DTYPE = [('shank', 'i4'), ('cluster', 'i4'), ('group', 'i4'),
+                 ('n_spikes', 'i8'), ('firing_rate', 'f8'),
+                 ('isi_violations', 'f8'), ('amplitude', 'f8'),
+                 ('snr', 'f8'), ('isolation_distance', 'f8')]
+
+
+def isi_violations(times, labels, nclusters, refractory):
+    """fraction of inter-spike intervals shorter than REFRACTORY samples in
+    each cluster. LABELS are cluster indices in range(nclusters)"""
+    order = np.lexsort((times, labels))
+    times, labels = times[order].astype(np.int64), labels[order]
+    same = labels[1:] == labels[:-1]
+    short = np.logical_and(same, np.diff(times) < refractory)
+    violations = np.bincount(labels[1:][short], minlength=nclusters)
+    intervals = np.bincount(labels[1:][same], minlength=nclusters)
+    return violations / np.maximum(intervals, 1)
+
+
+def block_starts(dataset, block_rows):
+    """row numbers starting blocks of about BLOCK_ROWS rows, aligned to chunks"""
+    chunk_rows = dataset.chunks[0] if dataset.chunks else 1
+    block_rows = max(1, block_rows // chunk_rows) * chunk_rows
+    return block_rows, range(0, len(dataset), block_rows)
+
+
+def feature_array(kwx_shank):
+    if 'features_masks' not in kwx_shank:
+        return None
+    return kwx_shank['features_masks']
+
+
+def first_pass(waves, features, labels, nclusters, block_rows):
+    """one pass over the waveforms and features of a shank. returns per spike
+    amplitudes, per cluster waveform sums and sums of squares, and feature
+    sums and sums of outer products"""
+    nsamples, nchannels = waves.shape[1:]
+    amplitudes = np.empty(len(waves))
+    wave_sums = np.zeros((nclusters, nsamples * nchannels))
+    wave_squares = np.zeros((nclusters, nsamples * nchannels))
+    nfeatures = features.shape[1] if features is not None else 0
+    feat_sums = np.zeros((nclusters, nfeatures))
+    feat_outer = np.zeros((nclusters, nfeatures, nfeatures))
+    block_rows, starts = block_starts(waves, block_rows)
+    for start in starts:
+        block = waves[start:start + block_rows].astype(float)
+        block_labels = labels[start:start + len(block)]
+        # peak to peak on the largest channel
+        amplitudes[start:start + len(block)] = \
+            (block.max(axis=1) - block.min(axis=1)).max(axis=1)
+        block = block.reshape(len(block), -1)
+        add_by_label(wave_sums, block_labels, block)
+        add_by_label(wave_squares, block_labels, block ** 2)
+        if features is None:
+            continue
+        feats = features[start:start + len(block), :, 0].astype(float)
+        add_by_label(feat_sums, block_labels, feats)
+        for k in np.unique(block_labels):
+            x = feats[block_labels == k]
+            feat_outer[k] += x.T.dot(x)
+    return amplitudes, wave_sums, wave_squares, feat_sums, feat_outer
+
+
+def isolation_distances(features, labels, counts, means, covs, dims,
+                        block_rows):
+    """isolation distance of each cluster: the Mahalanobis distance, in the
+    features DIMS[k] of cluster k, of the n-th closest spike outside the
+    cluster, where n is the cluster size"""
+    nclusters = len(counts)
+    inv_covs = []
+    for k in range(nclusters):
+        d = dims[k]
+        try:
+            inv_covs.append(np.linalg.inv(covs[k][np.ix_(d, d)]))
+        except np.linalg.LinAlgError:
+            inv_covs.append(None)
+    usable = [inv_covs[k] is not None and 2 <= counts[k] <= len(labels) - counts[k]
+              for k in range(nclusters)]
+    nearest = [np.zeros(0) for k in range(nclusters)]
+    block_rows, starts = block_starts(features, block_rows)
+    for start in starts:
+        feats = features[start:start + block_rows, :, 0].astype(float)
+        block_labels = labels[start:start + len(feats)]
+        for k in range(nclusters):
+            if not usable[k]:
+                continue
+            diff = feats[block_labels != k][:, dims[k]] - means[k][dims[k]]
+            dist = np.sum(diff.dot(inv_covs[k]) * diff, axis=1)
+            # keep the counts[k] smallest distances seen so far
+            dist = np.concatenate((nearest[k], dist))
+            if len(dist) > counts[k]:
+                dist = np.partition(dist, counts[k] - 1)[:counts[k]]
+            nearest[k] = dist
+    return np.array([np.max(nearest[k]) if usable[k] else np.nan
+                     for k in range(nclusters)])
+
+
+def shank_metrics(kwik_name, kwx_name, shank_name, sampling_rate=30000.,
+                  refractory=0.0015, block_rows=2**14, isolation=True,
+                  nchannels_isolation=4):
+    """quality metrics of every cluster of one shank, as a METRICS_DTYPE array"""
+    with h5py.File(kwik_name, 'r') as kwik, h5py.File(kwx_name, 'r') as kwx:
+        kwik_shank = kwik['channel_groups'][shank_name]
+        kwx_shank = kwx['channel_groups'][shank_name]
+        times = get_spike_times(kwik_shank)[:]
+        clusters, labels = np.unique(get_spike_cluster(kwik_shank)[:],
+                                     return_inverse=True)
+        nclusters = len(clusters)
+        groups = dict(get_cluster_group(kwik_shank))
+        waves = get_spike_waveforms(kwx_shank)
+        features = feature_array(kwx_shank) if isolation else None
+        nsamples, nchannels = waves.shape[1:]
+        amplitudes, wave_sums, wave_squares, feat_sums, feat_outer = \
+            first_pass(waves, features, labels, nclusters, block_rows)
+        counts = np.bincount(labels, minlength=nclusters)
+        n = np.maximum(counts, 1)
+        mean_waves = (wave_sums / n[:, None]).reshape(nclusters, nsamples, nchannels)
+        std_waves = np.sqrt(np.maximum(
+            wave_squares / n[:, None]
+            - (wave_sums / n[:, None]) ** 2, 0)).reshape(nclusters, nsamples, nchannels)
+        ptp = mean_waves.max(axis=1) - mean_waves.min(axis=1)
+        best = np.argmax(ptp, axis=1)
+        snr = (ptp[np.arange(nclusters), best]
+               / np.maximum(std_waves[np.arange(nclusters), :, best].mean(axis=1),
+                            np.finfo(float).eps))
+        if features is not None:
+            feat_means = feat_sums / n[:, None]
+            covs = (feat_outer / n[:, None, None]
+                    - feat_means[:, :, None] * feat_means[:, None, :])
+            # features are stored channel by channel, use those of the
+            # channels with the largest mean waveforms
+            per_channel = features.shape[1] // nchannels
+            dims = [np.concatenate([np.arange(c * per_channel, (c + 1) * per_channel)
+                                    for c in np.sort(np.argsort(ptp[k])[::-1]
+                                                     [:nchannels_isolation])])
+                    for k in range(nclusters)]
+            isolation_distance = isolation_distances(features, labels, counts,
+                                                     feat_means, covs, dims,
+                                                     block_rows)
+        else:
+            isolation_distance = np.nan * np.ones(nclusters)
+
+    order = np.argsort(labels, kind='mergesort')
+    amplitude = [np.median(a) if len(a) else np.nan
+                 for a in np.split(amplitudes[order], np.cumsum(counts)[:-1])]
+    duration = (times.max() - times.min()) / sampling_rate if len(times) else 0
+    table = np.zeros(nclusters, dtype=METRICS_DTYPE)
+    table['shank'] = int(shank_name)
+    table['cluster'] = clusters
+    table['group'] = [int(groups.get(c, -1)) for c in clusters]
+    table['n_spikes'] = counts
+    table['firing_rate'] = counts / duration if duration else np.nan
+    table['isi_violations'] = isi_violations(times, labels, nclusters,
+                                             refractory * sampling_rate)
+    table['amplitude'] = amplitude
+    table['snr'] = snr
+    table['isolation_distance'] = isolation_distance
+    return table
+
+
+def _shank_metrics(args):
+    return shank_metrics(*args)
+
+
+def session_metrics(kwik_name, kwx_name, sampling_rate=30000.,
+                    refractory=0.0015, isolation=True, jobs=1):
+    """metrics of all clusters of all shanks, shanks are computed in
+    parallel by JOBS processes"""
+    with h5py.File(kwik_name, 'r') as kwik:
+        shank_names = [s.name.split('/')[-1] for s in get_kwik_shanks(kwik)]
+    tasks = [(kwik_name, kwx_name, name, sampling_rate, refractory,
+              2**14, isolation) for name in shank_names]
+    if jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            tables = pool.map(_shank_metrics, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        tables = [_shank_metrics(t) for t in tasks]
+    return np.concatenate(tables) if tables else np.zeros(0, METRICS_DTYPE)
+
+
+def write_csv(filename, table):
+    fmt = ['%d', '%d', '%d', '%d', '%.4f', '%.5f', '%.2f', '%.3f', '%.3f']
+    np.savetxt(filename, table, fmt=fmt, delimiter=',',
+               header=','.join(table.dtype.names), comments='')
+
+
+def write_kwik(kwik_name, table, dset_name='cluster_metrics'):
+    """stores each shank's rows of TABLE as channel_groups/<shank>/DSET_NAME"""
+    with h5py.File(kwik_name, 'r+') as kwik:
+        for shank in np.unique(table['shank']):
+            group = kwik['channel_groups'][str(shank)]
+            if dset_name in group:
+                del group[dset_name]
+            group.create_dataset(dset_name, data=table[table['shank'] == shank])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('kwik', help='kwik file')
+    parser.add_argument('--kwx', help='kwx file, defaults to the kwik name with .kwx')
+    parser.add_argument('-o', '--out', help='csv file, defaults to KWIK.metrics.csv')
+    parser.add_argument('--sampling-rate', default=30000., type=float)
+    parser.add_argument('--refractory', default=0.0015, type=float,
+                        help='refractory period in seconds for ISI violations')
+    parser.add_argument('--no-isolation', action='store_true',
+                        help='skip isolation distance, which needs a second \
+                        pass over the features')
+    parser.add_argument('--write-kwik', action='store_true',
+                        help='also store the table in the kwik file')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='number of shanks processed in parallel')
+    args = parser.parse_args()
+    base = os.path.splitext(args.kwik)[0]
+    kwx = args.kwx or base + '.kwx'
+    table = session_metrics(args.kwik, kwx, args.sampling_rate,
+                            args.refractory, not args.no_isolation, args.jobs)
+    write_csv(args.out or base + '.metrics.csv', table)
+    if args.write_kwik:
+        write_kwik(args.kwik, table)
+
+
+if __name__ == '__main__':
+    main()
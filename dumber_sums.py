@@ -2,7 +2,9 @@
 
 from __future__ import division, unicode_literals
 import sys
+import os
 import argparse
+import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
 import h5py
@@ -10,13 +12,171 @@ import arf_vis_tools.arf_utils as arf_utils
 from scipy.signal import filtfilt, butter
 
 
-def dumber_sums(arf):
+def envelope_filters(sampling_rate):
+    """highpass and lowpass filters used to compute the response envelope"""
+    hb, ha = butter(2, 400 / (sampling_rate / 2), "highpass")
+    lb, la = butter(2, 200 / (sampling_rate / 2), "lowpass")
+    return hb, ha, lb, la
 
 
+def merge_windows(starts, stops, gap, step):
+    """merges [start, stop) windows separated by less than GAP samples,
+    returns interval starts (multiples of STEP) and stops"""
+    order = np.argsort(starts)
+    starts = starts[order] // step * step
+    stops = np.maximum.accumulate(stops[order])
+    new = np.concatenate(([True], starts[1:] > stops[:-1] + gap))
+    interval_starts = starts[new]
+    interval_stops = stops[np.concatenate((np.flatnonzero(new)[1:] - 1,
+                                           [len(stops) - 1]))]
+    return interval_starts, interval_stops
+
+
+def envelope(datasets, start, stop, filters, step, block, pad):
+    """the envelope (highpass, rectify, lowpass) of DATASETS between START and
+    STOP, every STEP samples. returns a (samples, channels) array.
+    The data is filtered in blocks of BLOCK samples with PAD samples of
+    context on each side. START and BLOCK must be multiples of STEP."""
+    hb, ha, lb, la = filters
+    n = min(len(d) for d in datasets)
+    out = np.empty((-(-(stop - start) // step), len(datasets)), dtype='float32')
+    for bstart in range(start, stop, block):
+        bstop = min(stop, bstart + block)
+        pstart, pstop = max(0, bstart - pad), min(n, bstop + pad)
+        x = np.empty((pstop - pstart, len(datasets)))
+        for i, dataset in enumerate(datasets):
+            x[:, i] = dataset[pstart:pstop]
+        env = filtfilt(lb, la, np.abs(filtfilt(hb, ha, x, axis=0)), axis=0)
+        rows = env[bstart - pstart:bstop - pstart:step]
+        out[(bstart - start) // step:(bstart - start) // step + len(rows)] = rows
+    return out
+
+
+def stimulus_envelopes(datasets, stimuli, stim_lengths, sampling_rate,
+                       buffer_length=0.5, step=None, block_duration=10.,
+                       pad_duration=0.1):
+    """envelope of each channel around every presentation of every stimulus.
+    Every channel is filtered once, over the union of all presentation
+    windows. STIM_LENGTHS maps stimulus names to lengths in samples.
+    The envelope is kept every STEP samples, by default about 1 kHz, so
+    windows are aligned to within STEP samples.
+    returns a dictionary mapping stimulus names to
+    (presentations, channels, samples) arrays, and the time in seconds of
+    each sample"""
+    if step is None:
+        step = max(1, int(sampling_rate // 1000))
+    filters = envelope_filters(sampling_rate)
+    n = min(len(d) for d in datasets)
+    buffer_samples = int(buffer_length * sampling_rate)
+    windows = {}
+    for stim_name, length in stim_lengths.items():
+        starts = stimuli["start"][stimuli["name"] == stim_name] - buffer_samples
+        stops = starts + 2 * buffer_samples + length
+        inside = np.logical_and(starts >= 0, stops <= n)
+        if not inside.all():
+            print("skipping {} presentations of {} outside the data"
+                  .format(np.sum(~inside), stim_name))
+        windows[stim_name] = (starts[inside].astype(int), stops[inside].astype(int))
+    pad = int(pad_duration * sampling_rate)
+    block = max(1, int(block_duration * sampling_rate) // step) * step
+    # an entry without stimuli has no windows and gives empty results
+    all_starts = np.concatenate([s for s, _ in windows.values()]
+                                + [np.zeros(0, int)])
+    all_stops = np.concatenate([s for _, s in windows.values()]
+                               + [np.zeros(0, int)])
+    if len(all_starts):
+        interval_starts, interval_stops = merge_windows(all_starts, all_stops,
+                                                        pad, step)
+        envelopes = [envelope(datasets, a, b, filters, step, block, pad)
+                     for a, b in zip(interval_starts, interval_stops)]
+        offsets = np.cumsum([0] + [len(e) for e in envelopes])[:-1]
+        envelopes = np.concatenate(envelopes)
+
+    responses = {}
+    times = {}
+    for stim_name, (starts, stops) in windows.items():
+        nsamples = (2 * buffer_samples + stim_lengths[stim_name]) // step
+        times[stim_name] = (np.arange(nsamples) * step - buffer_samples) / sampling_rate
+        if not len(starts):
+            responses[stim_name] = np.zeros((0, len(datasets), nsamples),
+                                            dtype='float32')
+            continue
+        interval = np.searchsorted(interval_starts, starts, 'right') - 1
+        rows = offsets[interval] + (starts - interval_starts[interval]) // step
+        idx = rows[:, None] + np.arange(nsamples)
+        responses[stim_name] = envelopes[idx].transpose(0, 2, 1)
+    return responses, times
+
+
+def summarize(responses):
+    """mean and variance across presentations of each stimulus response,
+    returns a dictionary of (channels, samples) arrays for each"""
+    empty = lambda r: np.full(r.shape[1:], np.nan, dtype=r.dtype)
+    means = {name: r.mean(axis=0) if len(r) else empty(r)
+             for name, r in responses.items()}
+    variances = {name: r.var(axis=0) if len(r) else empty(r)
+                 for name, r in responses.items()}
+    return means, variances
+
+
+def summary_key(arf, datasets, stimuli, params):
+    """digest identifying the inputs of a response summary: the stimulus
+    labels, the recorded datasets and the filter parameters"""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(stimuli).tobytes())
+    for dataset in datasets:
+        h.update(repr((dataset.name, dataset.shape, str(dataset.dtype),
+                       float(dataset.attrs["sampling_rate"]))).encode("utf-8"))
+    for name in sorted(arf['stimuli']):
+        h.update(repr((name, arf['stimuli'][name].shape)).encode("utf-8"))
+    h.update(repr(sorted(params.items())).encode("utf-8"))
+    stat = os.stat(arf.filename)
+    h.update(repr((stat.st_size, stat.st_mtime)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def text(name):
+    """a stimulus name as text, names read from arf or npz files are bytes"""
+    return name.decode("utf-8") if isinstance(name, bytes) else name
+
+
+def load_summary(cache, key):
+    """returns the cached means, variances, times and presentation counts,
+    or None if CACHE does not exist or was computed from other inputs"""
+    if not cache or not os.path.exists(cache):
+        return None
+    with np.load(cache) as f:
+        if text(f["key"].item()) != key:
+            return None
+        names = [text(x) for x in f["names"].tolist()]
+        return tuple({name: f["{}/{}".format(field, i)]
+                      for i, name in enumerate(names)}
+                     for field in ("mean", "var", "time", "count"))
+
+
+def save_summary(cache, key, means, variances, times, counts):
+    names = sorted(means)
+    arrays = {"key": np.array(key),
+              "names": np.array([text(x).encode("utf-8") for x in names])}
+    for i, name in enumerate(names):
+        arrays["mean/{}".format(i)] = means[name]
+        arrays["var/{}".format(i)] = variances[name]
+        arrays["time/{}".format(i)] = times[name]
+        arrays["count/{}".format(i)] = np.array(counts[name])
+    with open(cache, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def response_summary(arf, cache=None, buffer_length=0.5):
+    """per stimulus, per channel mean and variance of the response envelope.
+    If CACHE is a filename, results are read from it when it was computed
+    from the same inputs, and written to it otherwise.
+    returns dictionaries of means, variances, times and presentation
+    counts, keyed by stimulus name"""
     data_entry_name = arf_utils.data_entry_name(arf)
     data = arf[data_entry_name]
     try:
-        stimuli = data["stimulus_time"]
+        stimuli = data["stimulus_time"][:]
     except KeyError:
         raise KeyError("no dataset called stimulus_time in {}, run label_stim first"
                        .format(data.name))
@@ -26,49 +186,80 @@ def dumber_sums(arf):
     datasets = [x for x in arf_utils.entry_time_series_datasets(data)
                 if ("A-0" in x.name) or ("B-0" in x.name)]
     sampling_rate = datasets[0].attrs["sampling_rate"]
+    params = {"buffer_length": buffer_length, "highpass": 400,
+              "lowpass": 200, "order": 2}
+    key = summary_key(arf, datasets, stimuli, params)
+    summary = load_summary(cache, key)
+    if summary is not None:
+        return summary
+    stim_lengths = {name: int(len(arf['stimuli'][name])
+                              / arf['stimuli'][name].attrs["sampling_rate"]
+                              * sampling_rate)
+                    for name in stim_names}
+    responses, times = stimulus_envelopes(datasets, stimuli, stim_lengths,
+                                          sampling_rate, buffer_length)
+    # results are keyed by text names, as they are when read from the cache
+    responses = {text(name): r for name, r in responses.items()}
+    times = {text(name): t for name, t in times.items()}
+    means, variances = summarize(responses)
+    counts = {name: len(r) for name, r in responses.items()}
+    if cache:
+        save_summary(cache, key, means, variances, times, counts)
+    return means, variances, times, counts
 
-    for stim_name  in stim_names:
-        stim_data = arf['stimuli'][stim_name]  # get actual pcm data of stimulus
-        stim_t = np.arange(len(stim_data)) / stim_data.attrs["sampling_rate"]
-        fig, axs = plt.subplots(2, 1, sharex=True)
-        plt.subplots_adjust(hspace=0)
-        plt.title(stim_name)
-        axs[0].plot(stim_t, stim_data)  
-        # create psth from .5 seconds before stimulus to .5 after
-        psth_buffer_length = int(0.5 * sampling_rate)
-        psth_stim_length = int(len(stim_data) / stim_data.attrs["sampling_rate"]
-                               * sampling_rate)
-        psth_index =  np.arange(2 * psth_buffer_length + psth_stim_length) - psth_buffer_length
-        psth_t = psth_index / sampling_rate
-        data_sums = [np.zeros_like(psth_index) for x in datasets]
-        presentation_times = stimuli["start"][stimuli["name"]==stim_name]
-        hb, ha = butter(2, 400 / (sampling_rate / 2), "highpass")
-        lb, la = butter(2, 200 / (sampling_rate / 2), "lowpass")
-        for i, dataset in enumerate(datasets):
-            for presentation_time in presentation_times:
 
-                temp_data = dataset[psth_index[0] + presentation_time:
-                                        psth_index[-1] + presentation_time + 1]
-                data_sums[i] += filtfilt(lb, la, np.abs(filtfilt(hb, ha, temp_data)))
+def plot_response(arf, stim_name, data_means, psth_t):
+    stim_data = arf['stimuli'][stim_name]  # get actual pcm data of stimulus
+    stim_t = np.arange(len(stim_data)) / stim_data.attrs["sampling_rate"]
+    fig, axs = plt.subplots(2, 1, sharex=True)
+    plt.subplots_adjust(hspace=0)
+    plt.title(stim_name)
+    axs[0].plot(stim_t, stim_data)
+    # psth from .5 seconds before stimulus to .5 after
+    cum_maxes = np.cumsum(data_means.max(axis=1))
+    plot_offset = np.hstack(([0], cum_maxes))[:-1] / 2
+    axs[1].plot(psth_t, (data_means + plot_offset[:, None]).T)
+    plt.xlim(psth_t[0], psth_t[-1])
+    return fig
+
 
-        data_means = [x / len(presentation_times) for x in data_sums]
+def dumber_sums(arf, cache=None, png_dir=None, show=True):
+    means, variances, times, counts = response_summary(arf, cache)
 
-        cum_maxes = np.cumsum([max(x) for x in data_means])
-        plot_offset = np.hstack(([0], cum_maxes))[:-1] / 2
-        [axs[1].plot(psth_t, x + offset) for x, offset in zip(data_means, plot_offset)]
-        plt.xlim(psth_t[0], psth_t[-1])
-        plt.show()
-    
+    for stim_name in sorted(means):
+        if not counts[stim_name]:
+            continue
+        fig = plot_response(arf, stim_name, means[stim_name], times[stim_name])
+        if png_dir:
+            base = os.path.splitext(os.path.basename(arf.filename))[0]
+            fig.savefig(os.path.join(png_dir, "{}_{}.png".format(base, stim_name)))
+        if show:
+            plt.show()
+        plt.close(fig)
 
 
 def main():
     p = argparse.ArgumentParser(prog="dumber_sums.py",
                                 description="""Simple and relatively fast plotting to check
                                 for stimulus response prior to spike sorting""")
-    p.add_argument("arf", help="name of the arf file")
+    p.add_argument("arf", help="name of the arf file(s)", nargs="+")
+    p.add_argument("--headless", action="store_true",
+                   help="do not open plot windows, implies --cache")
+    p.add_argument("--cache", action="store_true",
+                   help="""save response means next to each arf file as
+                   ARF_sums.npz, and reuse them while the inputs are unchanged""")
+    p.add_argument("--png", help="directory in which to save a plot of each stimulus")
     args = p.parse_args()
-    with h5py.File(args.arf, 'r') as arf:
-        dumber_sums(arf)
+    if args.headless:
+        plt.switch_backend("Agg")
+    if args.png and not os.path.isdir(args.png):
+        os.makedirs(args.png)
+    for arf_name in args.arf:
+        cache = None
+        if args.cache or args.headless:
+            cache = os.path.splitext(arf_name)[0] + "_sums.npz"
+        with h5py.File(arf_name, 'r') as arf:
+            dumber_sums(arf, cache, args.png, show=not args.headless)
 
 if __name__ == "__main__":
     sys.exit(main())
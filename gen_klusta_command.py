@@ -2,19 +2,141 @@ from subprocess import call
 import os.path
 from math import ceil
 import argparse
+from probe_model import load_probe, shank_sizes
+
+# rough MaskedKlustaKwik cost model: per fitted spike it keeps the features,
+# masks and corrections (3 floats per feature) and a log probability for
+# every cluster. Runtime is linear in fitted spikes * features * clusters.
+BYTES_PER_FLOAT = 4
+BASE_MEMORY = 200 * 2**20
+SECONDS_PER_UNIT = 6.5e-9
+# fewer fitted spikes than this per cluster and MaxPossibleClusters is
+# lowered rather than subsampling further
+MIN_SPIKES_PER_CLUSTER = 50
+
+
+def count_spikes(filebase, directory, shank_num, sample_bytes=2**20):
+    """number of spikes on a shank, from the kwik if there is one, otherwise
+    estimated from the size of the .clu file and the mean length of its
+    first lines (exact for files smaller than SAMPLE_BYTES)"""
+    base = os.path.join(directory, filebase)
+    kwik_filename = base + '.kwik'
+    if os.path.exists(kwik_filename):
+        import h5py
+        with h5py.File(kwik_filename, 'r') as kwik:
+            return len(kwik['channel_groups'][str(shank_num)]['spikes']['time_samples'])
+    clu_filename = "{}.clu.{}".format(base, shank_num)
+    size = os.path.getsize(clu_filename)
+    with open(clu_filename) as f:
+        head = f.read(sample_bytes)
+    nlines = head.count('\n')
+    if len(head) < size and nlines:
+        nlines = int(round(size * nlines / float(len(head))))
+    # the first line of a .clu file is the number of clusters
+    return max(nlines - 1, 0)
 
 
 def subset(filebase, directory, shank_num, max_spikes):
-    clu_filename = "{}.clu.{}".format(os.path.join(directory, filebase), 
-                                      shank_num)
-    Nspikes = float(sum(1 for line in open(clu_filename)))
+    Nspikes = float(count_spikes(filebase, directory, shank_num))
     return int(ceil(Nspikes/max_spikes))
 
 
+def probe_shanks(probe_fname):
+    """returns {shank number: number of channels} from a .probe file
+    (probes = {shank: edges}) or a .prb file (channel_groups)"""
+    return shank_sizes(load_probe(probe_fname))
+
+
+def read_prm(prm_fname):
+    """klustakwik settings of a klusta .prm file: nchannels,
+    nfeatures_per_channel and MaxPossibleClusters"""
+    variables = {}
+    exec(open(prm_fname, 'r').read(), variables)
+    return {k: variables[k] for k in ('nchannels', 'nfeatures_per_channel',
+                                      'MaxPossibleClusters')
+            if k in variables}
+
+
+def estimate_resources(nspikes, nchannels, subsample_factor,
+                       nfeatures_per_channel=3, maxclusters=None):
+    """predicted peak memory (bytes) and runtime (seconds) of a
+    MaskedKlustaKwik run"""
+    nfeatures = nchannels * nfeatures_per_channel + 1
+    if maxclusters is None:
+        maxclusters = 8 * nchannels
+    fitted = nspikes / float(max(subsample_factor, 1))
+    memory = BASE_MEMORY + BYTES_PER_FLOAT * (
+        nspikes * 3 * nfeatures + fitted * maxclusters)
+    seconds = SECONDS_PER_UNIT * fitted * nfeatures * maxclusters
+    return int(memory), seconds
+
+
+def tune_subset(nspikes, nchannels, nfeatures_per_channel=3, maxclusters=None,
+                max_spikes=800000, max_memory=None, max_seconds=None):
+    """the smallest -Subset factor fitting at most MAX_SPIKES spikes whose
+    predicted run stays within MAX_MEMORY bytes and MAX_SECONDS.
+    When the budget leaves fewer than MIN_SPIKES_PER_CLUSTER fitted spikes
+    per cluster, MAXCLUSTERS is lowered, down to 3 * NCHANNELS.
+    returns (subset, maxclusters, memory, seconds)"""
+    nfeatures = nchannels * nfeatures_per_channel + 1
+    if maxclusters is None:
+        maxclusters = 8 * nchannels
+    floor = min(maxclusters, 3 * nchannels)
+    # every spike's features and masks are loaded whatever the subset
+    loaded = BASE_MEMORY + BYTES_PER_FLOAT * nspikes * 3 * nfeatures
+    while True:
+        fitted = float(max_spikes)
+        if max_memory:
+            fitted = min(fitted, (max_memory - loaded)
+                         / float(BYTES_PER_FLOAT * maxclusters))
+        if max_seconds:
+            fitted = min(fitted, max_seconds
+                         / (SECONDS_PER_UNIT * nfeatures * maxclusters))
+        factor = min(max(int(ceil(nspikes / max(fitted, 1.))), 1),
+                     max(nspikes, 1))
+        too_few = nspikes / float(factor) < MIN_SPIKES_PER_CLUSTER * maxclusters
+        if fitted >= max_spikes or not too_few or maxclusters <= floor:
+            break
+        maxclusters = max(floor, maxclusters * 3 // 4)
+    memory, seconds = estimate_resources(nspikes, nchannels, factor,
+                                         nfeatures_per_channel, maxclusters)
+    return factor, maxclusters, memory, seconds
+
+
+def shank_job(filebase, directory, shank_num, nchannels, max_spikes=800000,
+              prm=None, max_memory=None, max_seconds=None):
+    """job description of one shank. With a .prm dictionary from read_prm or
+    a budget, -Subset and -MaxPossibleClusters are tuned by tune_subset"""
+    prm = prm or {}
+    nspikes = count_spikes(filebase, directory, shank_num)
+    factor, maxclusters, memory, seconds = tune_subset(
+        nspikes, nchannels, prm.get('nfeatures_per_channel', 3),
+        prm.get('MaxPossibleClusters'), max_spikes, max_memory, max_seconds)
+    tuned = prm or max_memory or max_seconds
+    return {'shank': shank_num, 'nchannels': nchannels,
+            'nspikes': nspikes, 'subset': factor, 'maxclusters': maxclusters,
+            'memory': memory, 'seconds': seconds,
+            'args': klustakwik_args(filebase, shank_num, factor,
+                                    maxclusters if tuned else None)}
+
+
+def plan_shanks(filebase, directory, probe_fname, max_spikes=800000,
+                prm=None, max_memory=None, max_seconds=None):
+    """one job description for each shank of the probe, largest first"""
+    jobs = [shank_job(filebase, directory, shank_num, nchannels, max_spikes,
+                      prm, max_memory, max_seconds)
+            for shank_num, nchannels in sorted(probe_shanks(probe_fname).items())]
+    return sorted(jobs, key=lambda j: j['seconds'], reverse=True)
+
+
 def klustakwik_strings(filebase, directory, shank_num, nchannels, max_spikes):
     subsample_factor = subset(filebase, directory, shank_num, max_spikes)
     minclus = 3 * nchannels
     maxclus = 8 * nchannels
+    return klustakwik_args(filebase, shank_num, subsample_factor)
+
+
+def klustakwik_args(filebase, shank_num, subsample_factor, maxclusters=None):
     klus_args = ['MaskedKlustaKwik',
                  filebase,
                  str(shank_num),
@@ -25,26 +147,25 @@ def klustakwik_strings(filebase, directory, shank_num, nchannels, max_spikes):
                  #'-SplitFirst', '40',
                  #'-SplitEvery', '100',
                  #'-MaxIter', '400',
-                 #'-MaxPossibleClusters', str(maxclus),
                  '-UseMaskedInitialConditions', '1',
                  '-Subset', str(subsample_factor)
     ]
+    if maxclusters is not None:
+        klus_args += ['-MaxPossibleClusters', str(maxclusters)]
     return klus_args
 
 
-def main(filebase, directory,
-         shank_num, nchannels=32, max_spikes=800000, torque=False):
-    filebase = os.path.split(filebase)[-1]
-    klus_args = klustakwik_strings(filebase, directory,
-                                   shank_num, nchannels, max_spikes)
+def write_script(filebase, directory, shank_num, klus_args, torque=False,
+                 memory=None):
     scriptname = "{}.{}.sh".format(os.path.join(directory, filebase),
                                    shank_num)
-    print torque
     with open(scriptname, 'w') as f:
         if torque == 'beast':
             f.write('#PBS -N {}{}\n'.format(filebase[-15:], shank_num))
             f.write('#PBS -o {}_{}_err.txt\n'.format(filebase, shank_num))
             f.write('#PBS -l nodes=1:ppn=5\n')
+            if memory:
+                f.write('#PBS -l mem={}mb\n'.format(int(ceil(memory / 2.**20))))
             f.write('#PBS -l walltime=192:00:00\n')
             f.write('#PBS -V\n')
             f.write('cd $PBS_O_WORKDIR\n')
@@ -61,6 +182,68 @@ def main(filebase, directory,
             f.write(" ".join(klus_args) + '\n')
 
     call(['chmod', 'u+x', scriptname])
+    return scriptname
+
+
+def main(filebase, directory,
+         shank_num, nchannels=32, max_spikes=800000, torque=False,
+         prm=None, max_memory=None, max_seconds=None):
+    filebase = os.path.split(filebase)[-1]
+    if prm or max_memory or max_seconds:
+        job = shank_job(filebase, directory, shank_num, nchannels, max_spikes,
+                        prm, max_memory, max_seconds)
+        print_plan([job], max_memory)
+        klus_args = job['args']
+    else:
+        klus_args = klustakwik_strings(filebase, directory,
+                                       shank_num, nchannels, max_spikes)
+    print torque
+    write_script(filebase, directory, shank_num, klus_args, torque)
+
+
+def print_plan(plan, max_memory=None):
+    """prints the predicted peak memory and runtime of each shank"""
+    for job in plan:
+        print("shank {shank}: {nspikes} spikes, {nchannels} channels, "
+              "subset {subset}, {maxclusters} clusters max, "
+              "~{mem:.1f} GB peak, ~{hours:.1f} h{over}"
+              .format(mem=job['memory'] / 2.**30, hours=job['seconds'] / 3600.,
+                      over=' (OVER BUDGET)' if max_memory
+                      and job['memory'] > max_memory else '', **job))
+
+
+def write_job_array(filebase, directory, plan, torque, after=None):
+    """writes a script per shank and, for torque, a submit script that queues
+    them all, and AFTER, a command run once every shank has finished"""
+    if not torque:
+        return [write_script(filebase, directory, job['shank'], job['args'])
+                for job in plan]
+    submit_name = "{}.submit.sh".format(os.path.join(directory, filebase))
+    with open(submit_name, 'w') as f:
+        f.write('#!/bin/sh\n')
+        f.write('JOBS=""\n')
+        for job in plan:
+            scriptname = write_script(filebase, directory, job['shank'],
+                                      job['args'], torque, job['memory'])
+            f.write('JOBS="$JOBS:$(qsub {})"\n'.format(os.path.basename(scriptname)))
+        if after:
+            f.write("echo '{}' | qsub -N {}_after -W depend=afterok$JOBS\n"
+                    .format(after, filebase[-15:]))
+    call(['chmod', 'u+x', submit_name])
+    return submit_name
+
+
+def run_local(plan, filebase, directory, cores=None, memory=None, poll=10):
+    """runs the shanks of PLAN as local processes with klusta_runner,
+    starting the largest job that fits in the free cores and memory (bytes).
+    Progress is kept in DIRECTORY/FILEBASE.runner.json, so a rerun only
+    starts the shanks that did not finish"""
+    import klusta_runner
+    for job in plan:
+        job['name'] = '{}.{}'.format(filebase, job['shank'])
+        job['cwd'] = directory
+    state_file = os.path.join(directory, filebase + '.runner.json')
+    return klusta_runner.run_jobs(plan, state_file, cores, memory, poll=poll)
 
 
 if __name__ == "__main__":
@@ -75,10 +258,42 @@ if __name__ == "__main__":
                         default='./')
     parser.add_argument('-s', '--shank-num', help="shank number",
                         default=1, type=int)
-    parser.add_argument('-n', '--n-channels', help='number of channels on shank',
-                        default=32, type=int)
+    parser.add_argument('-n', '--n-channels', help='number of channels on shank, \
+    defaults to nchannels of --prm or 32', type=int)
+    parser.add_argument('--prm', help="klusta .prm file, for nchannels, \
+    nfeatures_per_channel and MaxPossibleClusters")
+    parser.add_argument('--max-spikes', default=800000, type=int,
+                        help="most spikes to fit, sets -Subset")
+    parser.add_argument('--budget-memory', type=float, help="GB each shank \
+    may use, -Subset and -MaxPossibleClusters are chosen to fit")
+    parser.add_argument('--budget-hours', type=float, help="hours each shank \
+    may run, -Subset and -MaxPossibleClusters are chosen to fit")
     parser.add_argument('-t', '--torque', help="for running on beast or beagle, \
     say 'beast' or 'beagle'.")
+    parser.add_argument('-p', '--probe', help=".probe or .prb file, plan a job \
+    for every shank instead of only --shank-num")
+    parser.add_argument('--after', help="with --probe and --torque, a command \
+    to queue once all shanks are done")
+    parser.add_argument('--local', action='store_true', help="with --probe, \
+    run the shanks on this machine instead of writing scripts")
+    parser.add_argument('--cores', type=int, help="cores available to --local")
+    parser.add_argument('--memory', type=float, help="GB available to --local")
     args = parser.parse_args()
-    main(args.filebase, args.directory, 
-         args.shank_num, args.n_channels, torque=args.torque)
+    prm = read_prm(args.prm) if args.prm else None
+    max_memory = args.budget_memory and args.budget_memory * 2**30
+    max_seconds = args.budget_hours and args.budget_hours * 3600
+    if args.probe:
+        filebase = os.path.split(args.filebase)[-1]
+        plan = plan_shanks(filebase, args.directory, args.probe, args.max_spikes,
+                           prm, max_memory, max_seconds)
+        print_plan(plan, max_memory)
+        if args.local:
+            run_local(plan, filebase, args.directory, args.cores,
+                      args.memory and args.memory * 2**30)
+        else:
+            write_job_array(filebase, args.directory, plan, args.torque,
+                            args.after)
+    else:
+        nchannels = args.n_channels or (prm or {}).get('nchannels', 32)
+        main(args.filebase, args.directory, args.shank_num, nchannels,
+             args.max_spikes, args.torque, prm, max_memory, max_seconds)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+from __future__ import division, print_function
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import subprocess
+import time
+import gen_klusta_command
+
+description = '''
+klusta_runner.py
+
+runs MaskedKlustaKwik on every shank of many sessions, or klusta on .prm
+files, on this machine. Jobs start when enough cores and memory are free,
+progress is kept in a state file so an interrupted run can be resumed, and
+the wall time and peak memory of each job are added to a history used to
+correct later resource estimates.
+'''
+
+DEFAULT_HISTORY = os.path.expanduser(os.path.join('~', '.spikechef',
+                                                  'klusta_history.jsonl'))
+
+
+def read_json(filename, default):
+    if not os.path.exists(filename):
+        return default
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_json(filename, data):
+    """writes DATA to FILENAME through a temporary file, so a crash never
+    leaves a partial state file"""
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def read_history(filename):
+    if not filename or not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(filename, record):
+    if not filename:
+        return
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def calibration(history):
+    """median ratio of measured to predicted memory and runtime of finished
+    jobs, 1 if there is no history"""
+    done = [r for r in history if r.get('returncode') == 0
+            and r.get('memory') and r.get('seconds')]
+    if not done:
+        return 1., 1.
+    median = lambda x: sorted(x)[len(x) // 2]
+    return (median([r['peak_rss'] / float(r['memory']) for r in done]),
+            median([r['wall_time'] / float(r['seconds']) for r in done]))
+
+
+def session_jobs(session, probe, max_spikes=800000, prm_memory=4 * 2**30):
+    """jobs for a session: one MaskedKlustaKwik job per shank when SESSION is
+    a file base, which needs the PROBE file, or a klusta job when it is a
+    .prm file"""
+    directory, filebase = os.path.split(os.path.abspath(session))
+    if session.endswith('.prm'):
+        return [{'name': filebase, 'cwd': directory,
+                 'args': ['klusta', filebase],
+                 'memory': prm_memory, 'seconds': 0}]
+    if not probe:
+        raise ValueError('a probe file is needed to plan the shanks of {}'
+                         .format(session))
+    jobs = gen_klusta_command.plan_shanks(filebase, directory, probe,
+                                          max_spikes)
+    for job in jobs:
+        job['name'] = '{}.{}'.format(filebase, job['shank'])
+        job['cwd'] = directory
+    return jobs
+
+
+def start_job(job, log_dir):
+    log_name = os.path.join(log_dir, job['name'] + '.log')
+    offset = os.path.getsize(log_name) if os.path.exists(log_name) else 0
+    log = open(log_name, 'ab')
+    proc = subprocess.Popen(job['args'], cwd=job['cwd'], stdout=log,
+                            stderr=subprocess.STDOUT)
+    log.close()
+    return {'proc': proc, 'log': log_name, 'offset': offset,
+            'start': time.time()}
+
+
+def reap(running):
+    """collects finished processes, returns {name: (returncode, peak rss)}"""
+    finished = {}
+    for name, run in running.items():
+        pid, status, usage = os.wait4(run['proc'].pid, os.WNOHANG)
+        if pid == 0:
+            continue
+        run['proc'].returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                                  else -os.WTERMSIG(status))
+        # ru_maxrss is in kilobytes on Linux
+        finished[name] = (run['proc'].returncode, usage.ru_maxrss * 1024)
+    return finished
+
+
+def follow_logs(running):
+    """prints new lines of every running job's log"""
+    for name, run in running.items():
+        with open(run['log'], 'rb') as f:
+            f.seek(run['offset'])
+            text = f.read()
+        run['offset'] += len(text)
+        for line in text.decode('utf-8', 'replace').splitlines():
+            print('[{}] {}'.format(name, line))
+
+
+def run_jobs(jobs, state_file, cores=None, memory=None, log_dir=None,
+             history_file=DEFAULT_HISTORY, follow=False, poll=10):
+    """runs JOBS (dictionaries with 'name', 'cwd', 'args', 'memory' in bytes
+    and 'seconds'), largest memory first, at most CORES at once and within
+    MEMORY bytes of predicted use. Jobs recorded as done in STATE_FILE are
+    skipped. returns the state dictionary"""
+    cores = cores or multiprocessing.cpu_count()
+    memory = memory or float('inf')
+    log_dir = log_dir or os.path.dirname(os.path.abspath(state_file))
+    mem_scale, time_scale = calibration(read_history(history_file))
+    state = read_json(state_file, {})
+    pending = [j for j in sorted(jobs, key=lambda j: j['memory'], reverse=True)
+               if state.get(j['name'], {}).get('status') != 'done']
+    for job in jobs:
+        if state.get(job['name'], {}).get('status') == 'done':
+            print('{} already done, skipping'.format(job['name']))
+    running = {}
+    by_name = {}
+    try:
+        while pending or running:
+            if follow:
+                follow_logs(running)
+            for name, (code, rss) in reap(running).items():
+                run = running.pop(name)
+                job = by_name[name]
+                wall = time.time() - run['start']
+                state[name] = {'status': 'done' if code == 0 else 'failed',
+                               'returncode': code, 'wall_time': wall,
+                               'peak_rss': rss, 'log': run['log']}
+                write_json(state_file, state)
+                append_history(history_file, {
+                    'name': name, 'returncode': code, 'wall_time': wall,
+                    'peak_rss': rss, 'memory': job['memory'],
+                    'seconds': job['seconds'], 'nspikes': job.get('nspikes'),
+                    'nchannels': job.get('nchannels'),
+                    'subset': job.get('subset')})
+                print('{} {} in {:.0f} s, peak memory {:.2f} GB'.format(
+                    name, 'finished' if code == 0 else 'FAILED ({})'.format(code),
+                    wall, rss / 2.**30))
+            used = sum(by_name[name]['memory'] * mem_scale for name in running)
+            for job in list(pending):
+                fits = used + job['memory'] * mem_scale <= memory or not running
+                if len(running) >= cores or not fits:
+                    continue
+                print('starting {} (~{:.2f} GB, ~{:.1f} h)'.format(
+                    job['name'], job['memory'] * mem_scale / 2.**30,
+                    job['seconds'] * time_scale / 3600.))
+                running[job['name']] = start_job(job, log_dir)
+                by_name[job['name']] = job
+                state[job['name']] = {'status': 'running'}
+                write_json(state_file, state)
+                pending.remove(job)
+                used += job['memory'] * mem_scale
+            if running:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        for run in running.values():
+            run['proc'].terminate()
+        raise
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('sessions', nargs='+',
+                        help='session file bases (path/to/filebase) or .prm files')
+    parser.add_argument('-p', '--probe', help='.probe or .prb file of the sessions, \
+                        needed unless all sessions are .prm files')
+    parser.add_argument('--cores', type=int, help='maximum concurrent jobs')
+    parser.add_argument('--memory', type=float, help='GB available to the jobs')
+    parser.add_argument('--state', default='klusta_runner.json',
+                        help='state file, rerun with the same file to resume')
+    parser.add_argument('--logs', help='directory for job logs, \
+                        defaults to the directory of the state file')
+    parser.add_argument('--history', default=DEFAULT_HISTORY,
+                        help='file recording resource use of finished jobs')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='print job output as it is written')
+    args = parser.parse_args()
+    if not args.probe and not all(s.endswith('.prm') for s in args.sessions):
+        parser.error('--probe is needed for sessions given as file bases')
+    jobs = [job for session in args.sessions
+            for job in session_jobs(session, args.probe)]
+    run_jobs(jobs, args.state, args.cores,
+             args.memory and args.memory * 2**30, args.logs, args.history,
+             args.follow)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,18 @@
 from __future__ import division
 import os.path
 import argparse
+import hashlib
+import json
+from fractions import Fraction
 import h5py
 import numpy as np
-from scipy.signal import cheby2, filtfilt
+from scipy.signal import cheby2, filtfilt, resample_poly
 import arf
 from numpy.lib import recfunctions
 import stimalign
 from utils import jstim_log_sequence, arf_samplerate
+from probe_model import load_probe
+from arf_index import get_index
 
 __version__ = '0.3.0'
 
@@ -26,23 +31,115 @@ def add_shank_field(array, shanknum):
                                       dtypes=np.uint16, usemask=False)
 
 
-# populate spike metadata
-def spike_metadata(kwik_file, spikes_file):
+def append_dataset(group, name, data, compression=None, **attributes):
+    """appends DATA to GROUP[NAME] along the first axis, growing it in place.
+    If NAME does not exist it is created chunked and resizable, as an arf
+    dataset when ATTRIBUTES are given, otherwise as a plain hdf5 dataset."""
+    if name in group:
+        dset = group[name]
+        nrows = dset.shape[0]
+        dset.resize(nrows + len(data), axis=0)
+        dset[nrows:] = data
+        return dset
+    maxshape = (None,) + data.shape[1:]
+    if attributes:
+        return arf.create_dataset(group, name, data, maxshape=maxshape,
+                                  compression=compression, **attributes)
+    return group.create_dataset(name, data=data, maxshape=maxshape,
+                                chunks=True, compression=compression)
+
+
+def shank_metadata(kwik_file):
+    """the clusters and groups_of_clusters tables of every shank, with a
+    shank field numbered from 1"""
     for shanknum, shank in enumerate(kwik_file['shanks'].values()):
-        clusters = add_shank_field(shank['clusters'].value, shanknum+1)
-        groups_of_clusters = add_shank_field(shank['groups_of_clusters'],
-                                             shanknum+1)
-        if 'clusters' not in spikes_file:
-            spikes_file.create_dataset('clusters', data=clusters)
-            spikes_file.create_dataset('groups_of_clusters',
-                                       data=groups_of_clusters)
-        else:
-            spikes_file['clusters'] = np.append(spikes_file['clusters'], clusters)
-            spikes_file['groups_of_clusters'] = np.append(spikes_file['groups_of_clusters'],
-                                                          groups_of_clusters)
+        yield (add_shank_field(shank['clusters'].value, shanknum+1),
+               add_shank_field(shank['groups_of_clusters'], shanknum+1))
+
+
+# populate spike metadata
+def spike_metadata(kwik_file, spikes_file, compression=None):
+    for clusters, groups_of_clusters in shank_metadata(kwik_file):
+        append_dataset(spikes_file, 'clusters', clusters, compression)
+        append_dataset(spikes_file, 'groups_of_clusters', groups_of_clusters,
+                       compression)
+    spikes_file.attrs['kwik_digests'] = json.dumps(kwik_digests(kwik_file))
     return None
 
 
+def label_fields(spikes):
+    """the fields of a kwik spikes table holding cluster assignments"""
+    return [x for x in spikes.dtype.names if x.startswith('cluster')]
+
+
+def kwik_digests(kwik_file):
+    """for each shank, digests of the spike times, of the cluster
+    assignments of the spikes and of the cluster tables"""
+    digest = lambda *arrays: hashlib.sha1(b''.join(
+        np.ascontiguousarray(x).tobytes() for x in arrays)).hexdigest()
+    digests = []
+    for shank in kwik_file['shanks'].values():
+        spikes = shank['spikes']
+        digests.append({
+            'times': digest(spikes['time']),
+            'labels': digest(*[spikes[x] for x in label_fields(spikes)]),
+            'metadata': digest(shank['clusters'][:],
+                               shank['groups_of_clusters'][:])})
+    return digests
+
+
+def rewrite_dataset(group, name, data):
+    """replaces the contents of the resizable dataset GROUP[NAME] by DATA"""
+    dset = group[name]
+    dset.resize(len(data), axis=0)
+    dset[...] = data
+
+
+def update_spikes(kwik_file, spikes_file, verbose=True):
+    """brings a spikes file written by main or merge up to date with a
+    re-curated kwik file. Only the cluster columns of the spikes of shanks
+    whose assignments changed, and the cluster tables, are rewritten;
+    waveforms are left untouched. Raises ValueError if the spike times
+    changed, or the file was written without digests, in which case it must
+    be exported again. returns the numbers of the updated shanks"""
+    current = kwik_digests(kwik_file)
+    stored = json.loads(spikes_file.attrs.get('kwik_digests', '[]'))
+    if (len(stored) != len(current)
+            or any(s['times'] != c['times'] for s, c in zip(stored, current))):
+        raise ValueError('spike times differ from the exported ones, '
+                         'export {} again'.format(spikes_file.filename))
+    if any(s['metadata'] != c['metadata'] for s, c in zip(stored, current)):
+        tables = list(shank_metadata(kwik_file))
+        rewrite_dataset(spikes_file, 'clusters',
+                        np.concatenate([c for c, g in tables]))
+        rewrite_dataset(spikes_file, 'groups_of_clusters',
+                        np.concatenate([g for c, g in tables]))
+        if verbose:
+            print('rewrote cluster tables')
+    changed = [shanknum for shanknum, (s, c) in enumerate(zip(stored, current))
+               if s['labels'] != c['labels']]
+    entries = [x for x in spikes_file.values() if isinstance(x, h5py.Group)
+               and 'kwik_start_sample' in x.attrs]
+    index = spike_time_index(kwik_file)
+    for shanknum in changed:
+        shank_group, times, order = index[shanknum]
+        spikes = shank_group['spikes']
+        labels = {x: spikes[x] for x in label_fields(spikes)}
+        dset_name = 'spikes_{}'.format(shanknum + 1)
+        for entry in entries:
+            window = spike_window(times, order,
+                                  entry.attrs['kwik_start_sample'],
+                                  entry.attrs['kwik_stop_sample'])
+            dset = entry[dset_name]
+            for field, values in labels.items():
+                dset[field] = values[window]
+        if verbose:
+            print('updated cluster assignments of shank {} in {} entries'
+                  .format(shanknum + 1, len(entries)))
+    spikes_file.attrs['kwik_digests'] = json.dumps(current)
+    return [shanknum + 1 for shanknum in changed]
+
+
 def find_and_write_pulse_time(arf_file, arf_entry_name, pulsechan,
                               spike_entry, verbose=True):
             pulsetime = stimalign.detect_pulse(arf_file[arf_entry_name][pulsechan])
@@ -55,22 +152,63 @@ def find_and_write_pulse_time(arf_file, arf_entry_name, pulsechan,
 
 
 def dataset_length(entry):
-    return next((len(x) for x in entry.values()
-                 if type(x) == h5py.Dataset
-                 and 'datatype' in x.attrs.keys()
-                 and x.attrs['datatype'] < 1000), 0)
+    index = get_index(entry.file)
+    i = np.flatnonzero(index['entries'] == entry.name[1:])
+    return int(index['entry_lengths'][i[0]]) if len(i) else 0
+
 
+def arf_info(arf_file):
+    """entry names in order, their lengths in samples and the sampling rate
+    of an arf file, from the arf index"""
+    index = get_index(arf_file)
+    return {'keys': list(index['entries']),
+            'lengths': [int(x) for x in index['entry_lengths']],
+            'sampling_rate': arf_samplerate(arf_file)}
 
-def add_spikes(spike_entry, kwik_file, start_sample, stop_sample):
+
+def spike_time_index(kwik_file):
+    """reads the spike times of each shank once, returns a list of
+    (shank group, spike times, order) where ORDER is None if the times are
+    already sorted, otherwise the argsort of the times"""
+    index = []
+    for shank_group in kwik_file['shanks'].values():
+        times = shank_group['spikes']['time']
+        if np.all(times[1:] >= times[:-1]):
+            order = None
+        else:
+            order = np.argsort(times, kind='mergesort')
+            times = times[order]
+        index.append((shank_group, times, order))
+    return index
+
+
+def spike_window(times, order, start_sample, stop_sample):
+    """returns the spike indices with start_sample <= time < stop_sample,
+    as a slice when the spikes are sorted"""
+    lo, hi = np.searchsorted(times, [start_sample, stop_sample])
+    if order is None:
+        return slice(lo, hi)
+    # h5py fancy indexing needs increasing indices
+    return np.sort(order[lo:hi])
+
+
+def add_spikes(spike_entry, kwik_file, start_sample, stop_sample,
+               spike_samplerate, index=None, compression=None):
     """adds all spikes between the start and stop samples from kwik file
-    into spike_entry"""
-    for shanknum, shank_group in enumerate(kwik_file['shanks'].values()):
+    into spike_entry. INDEX is the output of spike_time_index, pass it when
+    calling add_spikes for many entries"""
+    if index is None:
+        index = spike_time_index(kwik_file)
+    for shanknum, (shank_group, times, order) in enumerate(index):
         allspikes = shank_group['spikes']
         allwaves = shank_group['waveforms']['waveform_filtered']
-        time_mask = np.logical_and(allspikes['time'] >= start_sample,
-                                   allspikes['time'] < stop_sample)
-        spikes = allspikes[time_mask]
-        waves = allwaves[time_mask]
+        window = spike_window(times, order, start_sample, stop_sample)
+        if isinstance(window, slice) or len(window):
+            spikes = allspikes[window]
+            waves = allwaves[window]
+        else:
+            spikes = allspikes[0:0]
+            waves = allwaves[0:0]
         # change 'time' field to 'start' for arf compatibility
         spikes.dtype.names = tuple([x if x != 'time' else 'start'
                                     for x in spikes.dtype.names])
@@ -78,55 +216,73 @@ def add_spikes(spike_entry, kwik_file, start_sample, stop_sample):
         spike_dset_name = 'spikes_{}'.format(shanknum + 1)
         waves_dset_name = 'waves_{}'.format(shanknum + 1)
 
-        if spike_dset_name not in spike_entry:
-            spike_samplerate = arf_samplerate(args.arf_list[0])  # TODO better method
-            units = [x.encode('utf8') for x in
-                     ('ID', 'ID', 'none', 'none', 'samples')]
-            arf.create_dataset(spike_entry, spike_dset_name,
-                               spikes,
-                               units=units,
-                               datatype=1001,
-                               sampling_rate=spike_samplerate)
-            arf.create_dataset(spike_entry, waves_dset_name, waves,
-                               units='samples', datatype=11001,
-                               sampling_rate=arf_samplerate(args.arf_list[0]))
-        else:
-            spike_entry[spike_dset_name].value = np.append(spike_entry[spike_dset_name], spikes)
-            spike_entry[waves_dset_name].value = np.append(spike_entry[waves_dset_name], waves)
+        units = [x.encode('utf8') for x in
+                 ('ID', 'ID', 'none', 'none', 'samples')]
+        append_dataset(spike_entry, spike_dset_name, spikes, compression,
+                       units=units, datatype=1001,
+                       sampling_rate=spike_samplerate)
+        append_dataset(spike_entry, waves_dset_name, waves, compression,
+                       units='samples', datatype=11001,
+                       sampling_rate=spike_samplerate)
 
 
 def add_lfp(spike_entry, raw_entry, Nlfp, cutoff=300, order=4,
-            ripple=20, lfp_sampling_rate=1000, verbose=True):
-    """adds first N lfp channels to the spike_entry"""
+            ripple=20, lfp_sampling_rate=1000, block_duration=10.,
+            overlap=0.1, verbose=True):
+    """adds first N lfp channels to the spike_entry
+
+    The channels are low pass filtered and resampled together in blocks of
+    BLOCK_DURATION seconds, padded by OVERLAP seconds on each side so that
+    block edges do not show in the output."""
     data_channels = [x for x in raw_entry.values()
                      if isinstance(x, h5py.Dataset)
                      and 'datatype' in x.attrs
                      and int(x.attrs['datatype']) < 1000]
     print(len(data_channels))
     data_channels = sorted(data_channels, key=repr)[:Nlfp]
-    
+    if not data_channels:
+        return
+    sampling_rate = data_channels[0].attrs['sampling_rate']
+    nsamples = min(len(chan) for chan in data_channels)
+    b, a = cheby2(order, ripple, cutoff / (sampling_rate / 2.))
+    ratio = Fraction(int(round(sampling_rate)),
+                     int(round(lfp_sampling_rate))).limit_denominator(1000)
+    up, down = ratio.denominator, ratio.numerator
+    # block boundaries fall on multiples of DOWN so that every block's
+    # resampled output lines up with the output sample grid
+    block = max(1, int(block_duration * sampling_rate) // down) * down
+    pad = int(np.ceil(overlap * sampling_rate / down)) * down
+    lfp_len = -(-nsamples * up // down)
+
+    lfp_dsets = []
     for chan in data_channels:
         if verbose:
             print("lfp chan: {}".format(chan))
-        # low pass filter
-        b, a = cheby2(order, ripple,
-                      cutoff / (chan.attrs['sampling_rate'] / 2.))
-        lfp = filtfilt(b, a, chan)
-        # resample
-        old_x = np.arange(len(chan)) / chan.attrs['sampling_rate']
-        resample_ratio = chan.attrs['sampling_rate'] / lfp_sampling_rate
-        new_x = np.arange(len(chan) / resample_ratio) / lfp_sampling_rate
-        resamp_lfp = np.interp(new_x, old_x, lfp)
-        arf.create_dataset(spike_entry, chan.name, resamp_lfp,
-                           units='samples', datatype=2,
+        dset = spike_entry.create_dataset(chan.name, shape=(lfp_len,),
+                                          dtype='float64')
+        arf.set_attributes(dset, units='samples', datatype=2,
                            sampling_rate=lfp_sampling_rate)
+        lfp_dsets.append(dset)
+
+    buf = np.empty((block + 2 * pad, len(data_channels)))
+    for start in range(0, nsamples, block):
+        stop = min(nsamples, start + block)
+        padded_start = max(0, start - pad)
+        padded_stop = min(nsamples, stop + pad)
+        x = buf[:padded_stop - padded_start]
+        for i, chan in enumerate(data_channels):
+            x[:, i] = chan[padded_start:padded_stop]
+        lfp = resample_poly(filtfilt(b, a, x, axis=0), up, down, axis=0)
+        out_start = start * up // down
+        out_stop = -(-stop * up // down)
+        offset = out_start - padded_start * up // down
+        for i, dset in enumerate(lfp_dsets):
+            dset[out_start:out_stop] = lfp[offset:offset + out_stop - out_start, i]
 
 
 def get_geometry(probe, verbose=True):
-    variables = {}
-    execfile(probe, variables)  # contains global variable geometry
-    geometry = variables['geometry']
-    geometry_array = np.array([v for v in geometry.values()])
+    # positions of every channel, in channel order
+    geometry_array = load_probe(probe)['positions']
     if verbose:
         print('geometry:')
         print(geometry_array)
@@ -136,19 +292,26 @@ def get_geometry(probe, verbose=True):
 def main(kwik_file, arf_file, spikes_file,
          stimlog=None, nlfp=0, pulsechan='', stimchannel='',
          probe=None, start_sample=0,
-         autodetect_pulse_channel=False, verbose=True):
-    if kwik_file is not None:
-        spike_metadata(kwik_file, spikes_file)
+         autodetect_pulse_channel=False, compression=None,
+         spike_index=None, spike_samplerate=None, info=None, verbose=True):
+    """adds the entries of ARF_FILE to SPIKES_FILE, returns the sample after
+    the last entry. When merging several arf files pass SPIKE_INDEX,
+    SPIKE_SAMPLERATE and INFO (see merge) so they are only computed once."""
+    if info is None:
+        info = arf_info(arf_file)
+    if spike_samplerate is None:
+        spike_samplerate = info['sampling_rate']
+    if kwik_file is not None and spike_index is None:
+        spike_metadata(kwik_file, spikes_file, compression)
+        spike_index = spike_time_index(kwik_file)
 
     if autodetect_pulse_channel:
         #determine pulse channel
         pulsechan = stimalign.autopulse_dataset_name(arf_file)
 
     # traverse arf entries, count samples, add kwik data to arf format
-    entries = [x for x in arf_file.values() if type(x) == h5py.Group]
-    entries = sorted(entries, key=repr)
-    keys = [k for k, x in arf_file.items() if type(x) == h5py.Group]
-    keys = sorted(keys, key=repr)
+    keys = info['keys']
+    entries = [arf_file[k] for k in keys]
 
     if stimlog:
         stim_sequence = jstim_log_sequence(stimlog)
@@ -158,12 +321,13 @@ def main(kwik_file, arf_file, spikes_file,
                   .format(len(stim_sequence), len(entries)))
     else:
         stim_sequence = [None for e in entries]
-    if probe:
+    if probe and 'geometry' not in spikes_file:
         spikes_file['geometry'] = get_geometry(probe)
     # adding spike times and waveforms, and such, creating spike entries
     # in spikes_file
     stop_sample = start_sample
-    for k, entry, stim_name in zip(keys, entries, stim_sequence):
+    for k, entry, length, stim_name in zip(keys, entries, info['lengths'],
+                                           stim_sequence):
         print(k)
         print(entry.name)
         print(entry.attrs['timestamp'])
@@ -186,14 +350,60 @@ def main(kwik_file, arf_file, spikes_file,
             add_lfp(spike_entry, arf_file[k], nlfp)
 
         start_sample = stop_sample  # update starting time for next entry
-        stop_sample = start_sample + dataset_length(entry)
+        stop_sample = start_sample + length
         if kwik_file is not None:
-            add_spikes(spike_entry, kwik_file, start_sample, stop_sample)
+            add_spikes(spike_entry, kwik_file, start_sample, stop_sample,
+                       spike_samplerate, spike_index, compression)
+            # for update_spikes
+            spike_entry.attrs['kwik_start_sample'] = start_sample
+            spike_entry.attrs['kwik_stop_sample'] = stop_sample
 
     print('Done!')
     return stop_sample
 
 
+def merge(kwik_file, arf_names, spikes_file, stimlog=None, nlfp=0,
+          pulsechan='', stimchannel='', probe=None, start_sample=0,
+          compression=None, verbose=True):
+    """adds every arf file in ARF_NAMES, in order, to SPIKES_FILE in a
+    single pass. The kwik spike index and cluster tables are read once.
+    Raises ValueError, before writing anything, if two arf files have an
+    entry of the same name.
+    returns the sample offset of each arf file and the final sample"""
+    infos = []
+    sources = {}
+    for arf_name in arf_names:
+        with h5py.File(arf_name, 'r') as arf_file:
+            infos.append(arf_info(arf_file))
+        for k in infos[-1]['keys']:
+            if k in sources:
+                raise ValueError('entry {} is in both {} and {}'
+                                 .format(k, sources[k], arf_name))
+            sources[k] = arf_name
+    spike_index = None
+    if kwik_file is not None:
+        spike_metadata(kwik_file, spikes_file, compression)
+        spike_index = spike_time_index(kwik_file)
+    spike_samplerate = None
+    offsets = []
+    for arf_name, info in zip(arf_names, infos):
+        with h5py.File(arf_name, 'r') as arf_file:
+            if spike_samplerate is None:
+                spike_samplerate = info['sampling_rate']
+            offsets.append(start_sample)
+            start_sample = main(kwik_file, arf_file, spikes_file,
+                                stimlog, nlfp, pulsechan, stimchannel, probe,
+                                start_sample=start_sample,
+                                compression=compression,
+                                spike_index=spike_index,
+                                spike_samplerate=spike_samplerate,
+                                info=info, verbose=verbose)
+    if verbose:
+        for arf_name, offset in zip(arf_names, offsets):
+            print("{}: sample offset {}".format(arf_name, offset))
+    return offsets, start_sample
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--kwik', help='hdf5 file containing the spike \
@@ -218,6 +428,12 @@ if __name__ == '__main__':
     parser.add_argument("--start-sample", default=0, type=int,
                         help="""sample number in kwik to start adding spikes,
                         useful when multiple arf files were sorted together""")
+    parser.add_argument('--compression', default=None, type=int,
+                        help='gzip level (0-9) for the spike and waveform datasets')
+    parser.add_argument('--update', action='store_true',
+                        help='''update the cluster assignments and tables of
+                        an existing output file after re-curating the kwik,
+                        without rewriting waveforms or reading the arf files''')
     args = parser.parse_args()
     """
     used_files = [args.kwik, args.arf]
@@ -234,19 +450,26 @@ if __name__ == '__main__':
     else:
         spikes_filename = args.out
 
-    start_sample = args.start_sample # defaults to 0
-    for arf_name in args.arf_list:
-        with  h5py.File(arf_name, 'r') as arf_file,\
-             arf.open_file(spikes_filename, 'w') as spikes_file:
+    if args.update:
+        if args.kwik is None:
+            parser.error('--update needs --kwik')
+        with arf.open_file(spikes_filename, 'r+') as spikes_file, \
+                h5py.File(args.kwik, 'r') as kwik_file:
+            update_spikes(kwik_file, spikes_file)
+    else:
+        with arf.open_file(spikes_filename, 'w') as spikes_file:
             if args.kwik is not None:
                 with h5py.File(args.kwik, 'r') as kwik_file:
-                    start_sample = main(kwik_file, arf_file, spikes_file,
-                                        args.stim, args.lfp, args.pulse,
-                                        args.stimchannel, args.probe,
-                                        start_sample=start_sample)
+                    offsets, start_sample = merge(kwik_file, args.arf_list,
+                                                  spikes_file, args.stim,
+                                                  args.lfp, args.pulse,
+                                                  args.stimchannel, args.probe,
+                                                  args.start_sample,
+                                                  args.compression)
             else:
-                start_sample = main(None, arf_file, spikes_file,
-                                    args.stim, args.lfp, args.pulse,
-                                    args.stimchannel, args.probe,
-                                    start_sample=start_sample)
-    print("final sample: {}".format(start_sample))
+                offsets, start_sample = merge(None, args.arf_list, spikes_file,
+                                              args.stim, args.lfp, args.pulse,
+                                              args.stimchannel, args.probe,
+                                              args.start_sample,
+                                              args.compression)
+        print("final sample: {}".format(start_sample))
@@ -5,6 +5,9 @@ import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import hsv_to_rgb
+from sidecar import load_sidecar, save_sidecar
+from probe_model import (kwik_probe, shank_channels, channel_index,
+                         geometry_table)
 
 # spike timing
 def get_kwik_shanks(kwik):
@@ -18,11 +21,10 @@ def get_spike_cluster(kwik_channel):
     return kwik_channel['spikes']['clusters']['main']
 
 
-def get_cluster_spikes(cluster_id, kwik_channel):
-    spikes = get_spike_times(kwik_channel)
-    spike_ids = get_spike_cluster(kwik_channel)
-    id_mask = spike_ids.value == cluster_id
-    return spikes[id_mask]
+def get_cluster_spikes(cluster_id, kwik_channel, index=None):
+    if index is None:
+        index = get_spike_index(kwik_channel)
+    return index_cluster_times(index, cluster_id)
 
 
 def get_cluster_group(kwik_channel):
@@ -40,6 +42,101 @@ def get_cluster_group_names(kwik_channel):
     label = [i.attrs['name'] for i in groups]
     return {i: l for l, i in zip(label, group_id)}
 
+# spike index
+
+def spike_index_filename(kwik_channel):
+    base = os.path.splitext(kwik_channel.file.filename)[0]
+    shank = kwik_channel.name.split('/')[-1]
+    return '{}.shank{}.spikeindex.npz'.format(base, shank)
+
+
+def build_spike_index(kwik_channel):
+    """returns a dictionary of arrays with the spikes of a shank sorted by
+    cluster group, then cluster, then time:
+    'order' - original spike numbers
+    'times' - spike times in samples
+    'clusters', 'cluster_offsets' - spikes of clusters[i] are
+        order[cluster_offsets[i]:cluster_offsets[i+1]]
+    'groups', 'group_offsets' - the same for cluster groups
+    'cluster_groups' - the group of each cluster"""
+    times = get_spike_times(kwik_channel)[:]
+    spike_clusters = get_spike_cluster(kwik_channel)[:]
+    cluster_table = sorted(get_cluster_group(kwik_channel))
+    table_ids = np.array([c for c, g in cluster_table], dtype=int)
+    table_groups = np.array([int(g) for c, g in cluster_table], dtype=int)
+    # clusters without a group entry are put in group -1
+    pos = np.clip(np.searchsorted(table_ids, spike_clusters), 0,
+                  max(len(table_ids) - 1, 0))
+    if len(table_ids):
+        known = table_ids[pos] == spike_clusters
+        spike_groups = np.where(known, table_groups[pos], -1)
+    else:
+        spike_groups = -np.ones(len(spike_clusters), dtype=int)
+    order = np.lexsort((spike_clusters, spike_groups))
+    sorted_clusters = spike_clusters[order]
+    sorted_groups = spike_groups[order]
+    cluster_starts = np.flatnonzero(np.concatenate(
+        ([True], np.diff(sorted_clusters) != 0))) if len(order) else np.zeros(0, int)
+    group_starts = np.flatnonzero(np.concatenate(
+        ([True], np.diff(sorted_groups) != 0))) if len(order) else np.zeros(0, int)
+    return {'order': order,
+            'times': times[order],
+            'clusters': sorted_clusters[cluster_starts],
+            'cluster_groups': sorted_groups[cluster_starts],
+            'cluster_offsets': np.append(cluster_starts, len(order)),
+            'groups': sorted_groups[group_starts],
+            'group_offsets': np.append(group_starts, len(order))}
+
+
+def get_spike_index(kwik_channel, cache=True):
+    """spike index of a shank (see build_spike_index), loaded from or saved
+    to a file next to the kwik when CACHE is True. The cached index is
+    rebuilt when the kwik file has been modified since."""
+    filename = spike_index_filename(kwik_channel)
+    stat = os.stat(kwik_channel.file.filename)
+    stamp = np.array([stat.st_size, stat.st_mtime])
+    index = load_sidecar(filename, stamp) if cache else None
+    if index is None:
+        index = build_spike_index(kwik_channel)
+        if cache:
+            save_sidecar(filename, stamp, index)
+    return index
+
+
+def index_cluster_slice(index, cluster_id):
+    """slice of the index arrays holding the spikes of CLUSTER_ID"""
+    i = np.flatnonzero(index['clusters'] == cluster_id)
+    if not len(i):
+        return slice(0, 0)
+    return slice(index['cluster_offsets'][i[0]], index['cluster_offsets'][i[0] + 1])
+
+
+def index_cluster_times(index, cluster_id):
+    return index['times'][index_cluster_slice(index, cluster_id)]
+
+
+def index_cluster_spikes(index, cluster_id):
+    """spike numbers (rows of the spike and waveform datasets) of CLUSTER_ID"""
+    return index['order'][index_cluster_slice(index, cluster_id)]
+
+
+def index_group_slice(index, group_id):
+    i = np.flatnonzero(index['groups'] == group_id)
+    if not len(i):
+        return slice(0, 0)
+    return slice(index['group_offsets'][i[0]], index['group_offsets'][i[0] + 1])
+
+
+def get_group_spike_times(kwik_channel, group, index=None):
+    """times of all spikes in the cluster group named GROUP, eg 'Good'"""
+    if index is None:
+        index = get_spike_index(kwik_channel)
+    group_ids = [i for i, name in get_cluster_group_names(kwik_channel).items()
+                 if name == group]
+    if not group_ids:
+        return np.zeros(0, dtype=index['times'].dtype)
+    return np.sort(index['times'][index_group_slice(index, group_ids[0])])
+
 # spike shape/location
 
 def get_spike_waveforms(kwx_shank):
@@ -51,59 +148,137 @@ def get_shank_channel_order(kwik_channel):
 
 
 def get_shank_geometry(kwik_channel):
-    channels = kwik_channel['channels'].values()
-    channel_nums = [int(i.name.split('/')[-1]) for i in channels]
-    channel_geometry = [i.attrs['position'] for i in channels]
-    shank_geometry = [np.insert(geo, 0, c_num)
-                      for c_num, geo in zip(channel_nums, channel_geometry)]
-    return np.array(shank_geometry)
+    """ returns an Nelectrode by 3 array of the shank, where each row has
+    electrode number, x position, y position, sorted by electrode number"""
+    probe = kwik_probe(kwik_channel.file)
+    shank = int(kwik_channel.name.split('/')[-1])
+    return geometry_table(probe, shank_channels(probe, shank))
 
 
 def get_shank_geometry_dict(kwik_channel):
-    channels = kwik_channel['channels'].values()
-    channel_nums = [int(i.name.split('/')[-1]) for i in channels]
-    channel_geometry = [i.attrs['position'] for i in channels]
-    return {n: geo for n, geo in zip(channel_nums, channel_geometry)}
+    probe = kwik_probe(kwik_channel.file)
+    channels = shank_channels(probe, int(kwik_channel.name.split('/')[-1]))
+    positions = probe['positions'][channel_index(probe, channels)]
+    return {int(n): geo for n, geo in zip(channels, positions)}
 
 
 def get_all_geometry(kwik):
     """ returns an Nelectrode by 3 array, where each row has
     electrode number, x position, y position"""
-    geometry = []
-    for kwik_channel in kwik['channel_groups'].values():
-        shank_geometry = get_shank_geometry(kwik_channel)
-        geometry.extend(shank_geometry)
-    geometry = np.array(geometry)
-    return geometry[np.argsort(geometry[:,0]),:]  # sorted by electrode number
-
-
-def plot_cluster_waves(kwx_shank, kwik_shank, cluster_id, nwaves=300, mean=True):
-    spikes = get_spike_times(kwik_shank)
-    spike_ids = get_spike_cluster(kwik_shank)
-    id_mask = spike_ids.value == cluster_id
-    spike_nums = np.arange(len(spikes))[id_mask]
-    # randomly select nwaves waves:
-    randomed_spike_nums = spike_nums[np.random.permutation(len(spike_nums))]
-    wave_ids = randomed_spike_nums[:nwaves]
-    wave_mask = np.zeros(get_spike_waveforms(kwx_shank).shape[0], 'bool')
-    wave_mask[wave_ids] = True
-    waves = get_spike_waveforms(kwx_shank)[wave_mask, :, :]
+    return geometry_table(kwik_probe(kwik))  # sorted by electrode number
+
+
+def read_rows(dataset, rows, batch_rows=None):
+    """reads the sorted row numbers ROWS of DATASET, one contiguous read per
+    chunk (or BATCH_ROWS rows if the dataset is not chunked) containing a
+    selected row"""
+    if batch_rows is None:
+        batch_rows = dataset.chunks[0] if dataset.chunks else 1024
+    out = np.empty((len(rows),) + dataset.shape[1:], dtype=dataset.dtype)
+    batches = rows // batch_rows
+    bounds = np.flatnonzero(np.diff(batches)) + 1
+    for sel in np.split(np.arange(len(rows)), bounds):
+        if not len(sel):
+            continue
+        start = batches[sel[0]] * batch_rows
+        block = dataset[start:min(len(dataset), start + batch_rows)]
+        out[sel] = block[rows[sel] - start]
+    return out
+
+
+def sample_cluster_waves(kwx_shank, kwik_shank, cluster_id, nwaves=300,
+                         index=None):
+    """up to NWAVES randomly chosen waveforms of CLUSTER_ID, in spike order"""
+    if index is None:
+        index = get_spike_index(kwik_shank)
+    spike_nums = index_cluster_spikes(index, cluster_id)
+    wave_ids = np.sort(np.random.permutation(spike_nums)[:nwaves])
+    return read_rows(get_spike_waveforms(kwx_shank), wave_ids)
+
+
+def wave_stats_filename(kwik_shank):
+    return spike_index_filename(kwik_shank).replace('.spikeindex.', '.wavestats.')
+
+
+def add_by_label(out, labels, values):
+    """adds each row of VALUES to the row of OUT given by LABELS, summing
+    rows of the same label with one reduceat over the rows sorted by label"""
+    if not len(labels):
+        return out
+    order = np.argsort(labels, kind='mergesort')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.concatenate(
+        ([True], sorted_labels[1:] != sorted_labels[:-1])))
+    out[sorted_labels[starts]] += np.add.reduceat(values[order], starts, axis=0)
+    return out
+
+
+def cluster_waveform_stats(kwx_shank, kwik_shank, block_rows=None, cache=True):
+    """mean and standard deviation waveform of every cluster of a shank,
+    computed in one pass over the waveforms. returns a dictionary with
+    'clusters', 'counts', and (clusters, samples, channels) 'mean' and 'std'
+    arrays. Results are cached next to the kwik while the kwik and kwx are
+    unchanged."""
+    filename = wave_stats_filename(kwik_shank)
+    stamp = np.array([x for f in (kwik_shank.file.filename, kwx_shank.file.filename)
+                      for x in (os.stat(f).st_size, os.stat(f).st_mtime)])
+    stats = load_sidecar(filename, stamp) if cache else None
+    if stats is not None:
+        return stats
+    waves = get_spike_waveforms(kwx_shank)
+    spike_clusters = get_spike_cluster(kwik_shank)
+    clusters, labels = np.unique(spike_clusters[:], return_inverse=True)
+    nfeatures = int(np.prod(waves.shape[1:]))
+    sums = np.zeros((len(clusters), nfeatures))
+    squares = np.zeros((len(clusters), nfeatures))
+    if block_rows is None:
+        chunk_rows = waves.chunks[0] if waves.chunks else 1
+        block_rows = max(1, 2**16 // chunk_rows) * chunk_rows
+    for start in range(0, len(waves), block_rows):
+        block = waves[start:start + block_rows].reshape(-1, nfeatures)
+        block = block.astype(float)
+        block_labels = labels[start:start + len(block)]
+        add_by_label(sums, block_labels, block)
+        add_by_label(squares, block_labels, block ** 2)
+    counts = np.bincount(labels, minlength=len(clusters))
+    n = np.maximum(counts, 1)[:, None]
+    mean = sums / n
+    std = np.sqrt(np.maximum(squares / n - mean ** 2, 0))
+    stats = {'clusters': clusters, 'counts': counts,
+             'mean': mean.reshape((len(clusters),) + waves.shape[1:]),
+             'std': std.reshape((len(clusters),) + waves.shape[1:])}
+    if cache:
+        save_sidecar(filename, stamp, stats)
+    return stats
+
+
+def plot_cluster_waves(kwx_shank, kwik_shank, cluster_id, nwaves=300, mean=True,
+                       stats=None):
+    """plots waveforms of a cluster at their positions on the probe. With
+    MEAN, plots the mean +- std of NWAVES random waveforms, or of all
+    waveforms when STATS from cluster_waveform_stats is given"""
     geometry = get_shank_geometry_dict(kwik_shank)
     channel_order = get_shank_channel_order(kwik_shank)
+    if mean and stats is not None:
+        i = np.flatnonzero(stats['clusters'] == cluster_id)[0]
+        means, stds = stats['mean'][i], stats['std'][i]
+    else:
+        waves = sample_cluster_waves(kwx_shank, kwik_shank, cluster_id,
+                                     nwaves).astype(float)
+        means, stds = waves.mean(axis=0), waves.std(axis=0)
     for i, ch_n in enumerate(channel_order):
         geox, geoy = geometry[ch_n]
-        wavey = waves[:, :, i].T
-        wavey += 300*geoy
-        wavex = np.arange(wavey.shape[0]) / 30000. * 1000
-        wavex += wavey.shape[0]*geox / 30000. * 1000
+        offset = 300*geoy
+        wavex = np.arange(means.shape[0]) / 30000. * 1000
+        wavex += means.shape[0]*geox / 30000. * 1000
         if mean:
-            wave_u = np.mean(wavey, 1)
-            wave_std = np.std(wavey, 1)
+            wave_u = means[:, i] + offset
+            wave_std = stds[:, i]
             plt.plot(wavex, wave_u, 'k')
             plt.fill_between(wavex, wave_u, wave_u+wave_std, color='grey', alpha=0.5)
             plt.fill_between(wavex, wave_u, wave_u-wave_std, color='grey', alpha=0.5)
         else:
-            plt.plot(wavex, wavey, 'k', alpha=0.1)
+            plt.plot(wavex, waves[:, :, i].T + offset, 'k', alpha=0.1)
 
 def N_colors(N, Srange=(.5, 1), Vrange=(.5, 1)):
     """returns N unique rgb colors for plotting,
@@ -124,6 +299,31 @@ def get_starts(arf, name):
     return time_dset['start'.encode('utf-8')][mask]
 
 
+def peristimulus_window(spike_times, starts, sampling_rate, pre=-2, post=4):
+    """spikes within (start + pre, start + post) of each start, all trials
+    at once. SPIKE_TIMES must be sorted, times are in samples and PRE, POST in
+    seconds. returns a flat array of spike times relative to their start and
+    trial offsets: trial i is flat[offsets[i]:offsets[i+1]]"""
+    return window_spikes(spike_times, starts, pre*sampling_rate,
+                         post*sampling_rate)
+
+
+def window_spikes(spike_times, starts, lo, hi, closed=False):
+    """spikes within (start + LO, start + HI) samples of each start, or
+    [start + LO, start + HI] if CLOSED. returns flat times and trial offsets
+    as peristimulus_window"""
+    starts = np.asarray(starts)
+    sides = ('left', 'right') if closed else ('right', 'left')
+    lo = np.searchsorted(spike_times, starts + lo, sides[0])
+    hi = np.searchsorted(spike_times, starts + hi, sides[1])
+    counts = np.maximum(hi - lo, 0)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    idx = np.repeat(lo - offsets[:-1], counts) + np.arange(offsets[-1])
+    flat = (np.asarray(spike_times)[idx].astype(int)
+            - np.repeat(starts, counts).astype(int))
+    return flat, offsets
+
+
 def peristimulus_times(arf, spike_times, label,
                        sampling_rate, pre=-2, post=4):
     """returns a list of spike time lists,
@@ -131,18 +331,60 @@ def peristimulus_times(arf, spike_times, label,
     spike_times and labels must had the same sampling_rate
     """
     starts = get_starts(arf, name=label)
-    peri_times = []
-    for start in starts:
-        mask = np.logical_and(spike_times > pre*sampling_rate + start,
-                              spike_times < post*sampling_rate + start)
-        epoch_times =  spike_times[mask].astype(int) - start
-        peri_times.append(epoch_times)
-    return peri_times
-
-
-def plot_raster(peri_times, spike_sr=30000):
-    for i, epoch_times in enumerate(peri_times):
-        plt.vlines(epoch_times/spike_sr, i, i+1)
+    spike_times = np.asarray(spike_times)
+    if np.any(spike_times[1:] < spike_times[:-1]):
+        spike_times = np.sort(spike_times)
+    flat, offsets = peristimulus_window(spike_times, starts, sampling_rate,
+                                        pre, post)
+    return np.split(flat, offsets[1:-1])
+
+
+def psth_counts(spike_times_list, starts_list, sampling_rate,
+                pre=-2, post=4, bin_size=0.01):
+    """binned spike counts of many clusters around many stimuli.
+    SPIKE_TIMES_LIST holds the sorted spike times (samples) of each cluster,
+    STARTS_LIST the presentation times (samples) of each stimulus.
+    returns a (clusters, stimuli, bins) array of counts summed over
+    presentations, the bin edges in seconds and the number of presentations
+    of each stimulus"""
+    # spikes are binned in whole samples, so spikes on an edge fall in the
+    # bin starting there and the last bin includes both edges, as in
+    # np.histogram
+    sample_edges = np.round(np.arange(pre, post + bin_size / 2., bin_size)
+                            * sampling_rate).astype(int)
+    edges = sample_edges / float(sampling_rate)
+    nbins = len(edges) - 1
+    ntrials = np.array([len(s) for s in starts_list])
+    starts = np.concatenate([np.asarray(s) for s in starts_list]) \
+        if len(starts_list) else np.zeros(0)
+    stim_ids = np.repeat(np.arange(len(starts_list)), ntrials)
+    counts = np.zeros((len(spike_times_list), len(starts_list), nbins), int)
+    for i, spike_times in enumerate(spike_times_list):
+        flat, offsets = window_spikes(spike_times, starts, sample_edges[0],
+                                      sample_edges[-1], closed=True)
+        bins = np.minimum(np.searchsorted(sample_edges, flat, 'right') - 1,
+                          nbins - 1)
+        trial_stim = np.repeat(stim_ids, np.diff(offsets))
+        keep = np.logical_and(bins >= 0, bins < nbins)
+        counts[i] = np.bincount(trial_stim[keep] * nbins + bins[keep],
+                                minlength=len(starts_list) * nbins
+                                ).reshape(len(starts_list), nbins)
+    return counts, edges, ntrials
+
+
+def plot_raster(peri_times, spike_sr=30000, ax=None):
+    """draws a raster as a single line collection. PERI_TIMES is a list of
+    spike times for each trial, or the (flat, offsets) output of
+    peristimulus_window"""
+    if isinstance(peri_times, tuple):
+        flat, offsets = peri_times
+    else:
+        offsets = np.concatenate(([0], np.cumsum([len(x) for x in peri_times])))
+        flat = np.concatenate(peri_times) if len(peri_times) else np.zeros(0)
+    trial = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    if ax is None:
+        ax = plt.gca()
+    return ax.vlines(flat / spike_sr, trial, trial + 1)
 
 
 def plot_song_spec(stimulus_dset):
@@ -159,11 +401,12 @@ def get_all_spike_times(kwik, group=None):
     all_spike_times = []
     for shank in shanks:
         shank_spikes = []
+        index = get_spike_index(shank)
         clusters = get_cluster_group(shank)
         cluster_groups = get_cluster_group_names(shank)
         for ith_cluster, (cluster_id, cl_group) in enumerate(clusters):
             if cluster_groups[int(cl_group)] == group:
-                spike_times = get_cluster_spikes(cluster_id, shank)
+                spike_times = index_cluster_times(index, cluster_id)
                 shank_spikes.append(spike_times)
         all_spike_times.append(shank_spikes)
     return all_spike_times
@@ -1,6 +1,29 @@
+from __future__ import division, print_function
+import argparse
+import os
+import os.path
+import time
+from multiprocessing import Pool
 import h5py
 import numpy as np
-import matplotlib.pyplot as plt
+import arf
+from probe_model import kwik_probe, geometry_table
+
+description = '''
+mergekwik2contarf.py
+
+exports the sorted spikes of every shank of a kwik/kwx pair into one
+continuous arf entry: spike times with cluster and group labels, the
+filtered waveforms, and the cluster and group tables of each shank.
+'''
+
+SPIKE_DTYPE = [('start', 'u8'), ('cluster', 'i4'), ('group', 'i4')]
+CLUSTER_DTYPE = [('cluster', 'i4'), ('group', 'i4'), ('n_spikes', 'i8')]
+GROUP_DTYPE = [('group', 'i4'), ('name', 'S64')]
+GEOMETRY_DTYPE = [('channel', 'i4'), ('shank', 'i4'), ('x', 'f8'), ('y', 'f8')]
+BLOCK_ROWS = 2**16
+SPIKE_CHUNK_ROWS = 2**14
+WAVE_CHUNK_BYTES = 2**20
 
 
 def get_spike_times(kwik_channel):
@@ -28,39 +51,209 @@ def get_cluster_group_names(kwik_channel):
 
 
 def get_spike_waveforms(kwx_channel):
-    pass
+    return kwx_channel['waveforms_filtered']
 
 
 def get_geometry(kwik):
     """ returns an Nelectrode by 3 array, where each row has
     electrode number, x position, y position"""
-    geometry = []
-    for kwik_channel in kwik['channel_groups'].values():
-        channels = kwik_channel['channels'].values()
-        channel_nums = [int(i.name.split('/')[-1]) for i in channels]
-        channel_geometry = [i.attrs['position'] for i in channels]
-        shank_geometry = [np.insert(geo, 0, c_num)
-                          for c_num, geo in zip(channel_nums, channel_geometry)]
-        geometry.extend(shank_geometry)
-    geometry = np.array(geometry)
-    
-    return geometry[argsort(geometry[:,0]),:] #sorted by electrode number
+    return geometry_table(kwik_probe(kwik))  # sorted by electrode number
 
 
-def geometry_array
+def geometry_array(kwik):
+    """channel number, shank and position of every electrode as a
+    GEOMETRY_DTYPE array sorted by channel, for storing in arf"""
+    probe = kwik_probe(kwik)
+    geometry = np.zeros(len(probe['channels']), dtype=GEOMETRY_DTYPE)
+    geometry['channel'] = probe['channels']
+    geometry['shank'] = probe['shank']
+    geometry['x'], geometry['y'] = probe['positions'].T
+    return geometry
 
-def main(kwik, kwx, arf):
-    pass
 
+def cluster_tables(kwik_channel, clusters, counts):
+    """the CLUSTER_DTYPE table of the shank's clusters and its GROUP_DTYPE
+    table of group names. CLUSTERS and COUNTS are the cluster ids and
+    spike counts found in the spikes"""
+    groups = get_cluster_group(kwik_channel)
+    ids = np.union1d(clusters, np.array(sorted(groups), dtype=int))
+    cluster_table = np.zeros(len(ids), dtype=CLUSTER_DTYPE)
+    cluster_table['cluster'] = ids
+    cluster_table['group'] = [groups.get(i, -1) for i in ids]
+    cluster_table['n_spikes'][np.searchsorted(ids, clusters)] = counts
+    names = get_cluster_group_names(kwik_channel)
+    group_table = np.array(sorted((i, l) for l, i in names.items()),
+                           dtype=GROUP_DTYPE)
+    return cluster_table, group_table
 
 
+def lookup_groups(clusters, group_ids, group_of):
+    """group of each of CLUSTERS, given sorted cluster ids GROUP_IDS and
+    their groups GROUP_OF. -1 for clusters without a group"""
+    if not len(group_ids):
+        return -np.ones(len(clusters), dtype='i4')
+    pos = np.minimum(np.searchsorted(group_ids, clusters), len(group_ids) - 1)
+    return np.where(group_ids[pos] == clusters, group_of[pos], -1)
 
-if __name__ == "__main__":
 
-    kwik_fname = "/home/kjbrown/forebrain_syrinx/data/k405/2014-05-16/site_1/k405_140516_cont.kwik"
-    kwx_fname = "/home/kjbrown/forebrain_syrinx/data/k405/2014-05-16/site_1/k405_140516_cont.kwx"
-    arf_fname = "/home/kjbrown/forebrain_syrinx/data/k405/2014-05-16/site_1/k405_140516.arf"
-    with h5py.File(kwik_fname, 'r') as kwik,\
-    h5py.File(kwx_fname, 'r') as kwx,\
-    h5py.File(arf_fname, 'r') as arf:
-        main(kwik, kwx, arf)
+def preallocate(group, name, shape, dtype, chunk_rows, compression,
+                **attributes):
+    """creates an empty chunked, compressed arf dataset of SHAPE"""
+    dset = group.create_dataset(name, shape=shape, dtype=dtype,
+                                chunks=(max(1, min(chunk_rows, shape[0])),)
+                                + tuple(shape[1:]),
+                                maxshape=(None,) + tuple(shape[1:]),
+                                compression=compression)
+    arf.set_attributes(dset, **attributes)
+    return dset
+
+
+def export_shank(kwik_channel, kwx_channel, out, sampling_rate,
+                 block_rows=BLOCK_ROWS, compression='gzip'):
+    """writes the spikes, waveforms, clusters and cluster groups of one shank
+    to group OUT as spikes_N, waves_N, clusters_N and cluster_groups_N.
+    Spikes are copied BLOCK_ROWS at a time, so memory does not grow with
+    the number of spikes"""
+    shank = kwik_channel.name.split('/')[-1]
+    times = get_spike_times(kwik_channel)
+    spike_clusters = get_spike_cluster(kwik_channel)
+    waves = get_spike_waveforms(kwx_channel) if kwx_channel is not None else None
+    nspikes = len(times)
+    groups = get_cluster_group(kwik_channel)
+    group_ids = np.array(sorted(groups), dtype=int)
+    group_of = np.array([groups[i] for i in group_ids], dtype='i4')
+
+    spikes = preallocate(out, 'spikes_{}'.format(shank), (nspikes,),
+                         SPIKE_DTYPE, SPIKE_CHUNK_ROWS, compression,
+                         units=['samples', 'ID', 'ID'], datatype=1001,
+                         sampling_rate=sampling_rate)
+    if waves is not None:
+        row_bytes = waves.dtype.itemsize * int(np.prod(waves.shape[1:]))
+        out_waves = preallocate(out, 'waves_{}'.format(shank), waves.shape,
+                                waves.dtype, WAVE_CHUNK_BYTES // row_bytes,
+                                compression, units='samples', datatype=11001,
+                                sampling_rate=sampling_rate)
+        # reads aligned to the source chunks
+        if waves.chunks:
+            block_rows = max(1, block_rows // waves.chunks[0]) * waves.chunks[0]
+
+    ids = np.zeros(0, dtype=int)
+    counts = np.zeros(0, dtype=int)
+    block = np.empty(min(block_rows, nspikes), dtype=SPIKE_DTYPE)
+    for start in range(0, nspikes, block_rows):
+        stop = min(nspikes, start + block_rows)
+        rows = block[:stop - start]
+        rows['start'] = times[start:stop]
+        rows['cluster'] = spike_clusters[start:stop]
+        rows['group'] = lookup_groups(rows['cluster'], group_ids, group_of)
+        spikes[start:stop] = rows
+        if waves is not None:
+            out_waves[start:stop] = waves[start:stop]
+        block_ids, block_counts = np.unique(rows['cluster'], return_counts=True)
+        ids, inverse = np.unique(np.concatenate((ids, block_ids)),
+                                 return_inverse=True)
+        counts = np.bincount(inverse, np.concatenate((counts, block_counts)),
+                             minlength=len(ids)).astype(int)
+
+    cluster_table, group_table = cluster_tables(kwik_channel, ids, counts)
+    out['clusters_{}'.format(shank)] = cluster_table
+    out['cluster_groups_{}'.format(shank)] = group_table
+    return nspikes
+
+
+def _export_shank(args):
+    """exports one shank into its own temporary file, so that shanks can be
+    written by separate processes. returns the temporary file name"""
+    kwik_name, kwx_name, shank, tmp_name, sampling_rate, compression = args
+    with h5py.File(kwik_name, 'r') as kwik, h5py.File(tmp_name, 'w') as out:
+        kwx = h5py.File(kwx_name, 'r') if kwx_name else None
+        try:
+            kwx_channel = kwx['channel_groups'][shank] if kwx else None
+            export_shank(kwik['channel_groups'][shank], kwx_channel, out,
+                         sampling_rate, compression=compression)
+        finally:
+            if kwx:
+                kwx.close()
+    return tmp_name
+
+
+def main(kwik_name, kwx_name, arf_name, entry_name='spikes', timestamp=None,
+         sampling_rate=30000., compression='gzip', jobs=1, verbose=True):
+    """exports every shank of KWIK_NAME (and the waveforms in KWX_NAME, if
+    given) into the entry ENTRY_NAME of ARF_NAME, replacing it. With JOBS > 1
+    shanks are exported in parallel through temporary files, which are then
+    copied into the entry"""
+    with h5py.File(kwik_name, 'r') as kwik:
+        shanks = sorted(kwik['channel_groups'].keys(), key=int)
+        geometry = geometry_array(kwik)
+    tstart = time.time()
+    with arf.open_file(arf_name, 'a') as arf_file:
+        if entry_name in arf_file:
+            del arf_file[entry_name]
+        entry = arf.create_entry(arf_file, entry_name,
+                                 timestamp if timestamp is not None else time.time())
+        if len(geometry):
+            entry['geometry'] = geometry
+        if jobs > 1 and len(shanks) > 1:
+            base = os.path.splitext(arf_name)[0]
+            tasks = [(kwik_name, kwx_name, shank,
+                      '{}.shank{}.tmp.h5'.format(base, shank),
+                      sampling_rate, compression) for shank in shanks]
+            pool = Pool(min(jobs, len(tasks)))
+            try:
+                for tmp_name in pool.imap(_export_shank, tasks):
+                    with h5py.File(tmp_name, 'r') as tmp:
+                        for name in tmp:
+                            tmp.copy(tmp[name], entry, name)
+                    os.remove(tmp_name)
+                    if verbose:
+                        print('copied {}'.format(tmp_name))
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            with h5py.File(kwik_name, 'r') as kwik:
+                kwx = h5py.File(kwx_name, 'r') if kwx_name else None
+                try:
+                    for shank in shanks:
+                        kwx_channel = kwx['channel_groups'][shank] if kwx else None
+                        n = export_shank(kwik['channel_groups'][shank],
+                                         kwx_channel, entry, sampling_rate,
+                                         compression=compression)
+                        if verbose:
+                            print('shank {}: {} spikes'.format(shank, n))
+                finally:
+                    if kwx:
+                        kwx.close()
+    if verbose:
+        print('exported {} shanks in {:.1f} s'.format(len(shanks),
+                                                      time.time() - tstart))
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('kwik', help='kwik file')
+    p.add_argument('arf', help='output arf file, created if needed')
+    p.add_argument('--kwx', help='kwx file with the waveforms, defaults to \
+    the kwik name with .kwx if it exists')
+    p.add_argument('-e', '--entry', default='spikes',
+                   help='name of the arf entry, replaced if it exists')
+    p.add_argument('--timestamp-from', help='arf file whose first entry \
+    gives the entry timestamp, usually the continuous recording')
+    p.add_argument('--sampling-rate', default=30000., type=float)
+    p.add_argument('--compression', default='gzip',
+                   help='hdf5 compression filter, "none" to disable')
+    p.add_argument('-j', '--jobs', default=1, type=int,
+                   help='number of shanks exported in parallel')
+    args = p.parse_args()
+    kwx_name = args.kwx or os.path.splitext(args.kwik)[0] + '.kwx'
+    if not os.path.exists(kwx_name):
+        kwx_name = None
+    timestamp = None
+    if args.timestamp_from:
+        with h5py.File(args.timestamp_from, 'r') as source:
+            first = sorted(source.keys())[0]
+            timestamp = source[first].attrs['timestamp']
+    compression = None if args.compression == 'none' else args.compression
+    main(args.kwik, kwx_name, args.arf, args.entry, timestamp,
+         args.sampling_rate, compression, args.jobs)
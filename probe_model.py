@@ -0,0 +1,157 @@
+from __future__ import division
+import os.path
+import numpy as np
+
+# probe models by absolute path, with the (mtime, size) they were built from
+_probes = {}
+
+
+def build_probe(shanks):
+    """returns a dictionary of arrays describing a probe, from SHANKS, a
+    dictionary {shank: (channels, edges, positions)} where CHANNELS is the
+    channel order of the shank, EDGES pairs of neighboring channels and
+    POSITIONS a dictionary {channel: (x, y)}:
+    'channels' - all channel numbers, sorted
+    'shank' - the shank of each channel
+    'positions' - (channels, 2) coordinates, nan where unknown
+    'adjacency' - (channels, channels) boolean neighbor graph
+    'channel_order' - channel numbers, shank by shank, in probe order
+    'shank_offsets' - channels of shank_ids[i] are
+        channel_order[shank_offsets[i]:shank_offsets[i+1]]
+    'shank_ids' - shank numbers, sorted"""
+    shank_ids = sorted(shanks)
+    channel_order = [int(c) for s in shank_ids for c in shanks[s][0]]
+    channels = np.unique(np.array(channel_order, dtype=int))
+    shank = -np.ones(len(channels), dtype=int)
+    positions = np.nan * np.ones((len(channels), 2))
+    adjacency = np.zeros((len(channels), len(channels)), dtype=bool)
+    for s in shank_ids:
+        chans, edges, geometry = shanks[s]
+        shank[np.searchsorted(channels, chans)] = s
+        for c, xy in geometry.items():
+            if c in chans:
+                positions[np.searchsorted(channels, c)] = xy[:2]
+        edges = np.array([e for e in edges if e[0] != e[1]], dtype=int)
+        if len(edges):
+            i, j = np.searchsorted(channels, edges.T)
+            adjacency[i, j] = adjacency[j, i] = True
+    sizes = [len(shanks[s][0]) for s in shank_ids]
+    return {'channels': channels,
+            'shank': shank,
+            'positions': positions,
+            'adjacency': adjacency,
+            'channel_order': np.array(channel_order, dtype=int),
+            'shank_offsets': np.cumsum([0] + sizes),
+            'shank_ids': np.array(shank_ids, dtype=int)}
+
+
+def parse_probe_file(probe_fname):
+    """reads a klusta .prb file (channel_groups) or a .probe file (probes =
+    {shank: edges}, geometry = {channel: (x, y)}), returns the SHANKS
+    argument of build_probe"""
+    variables = {}
+    exec(open(probe_fname, 'r').read(), variables)
+    if 'channel_groups' in variables:
+        return {int(s): (list(g['channels']), g.get('graph', []),
+                         g.get('geometry', {}))
+                for s, g in variables['channel_groups'].items()}
+    geometry = variables.get('geometry') or {}
+    shanks = {}
+    for s, edges in variables['probes'].items():
+        channels = []
+        for edge in edges:
+            channels.extend(c for c in edge if c not in channels)
+        shanks[int(s)] = (channels, edges, geometry)
+    return shanks
+
+
+def load_probe(probe_fname):
+    """the probe model (see build_probe) of a .probe or .prb file. The file
+    is only read again when it has been modified"""
+    path = os.path.abspath(probe_fname)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    if path not in _probes or _probes[path][0] != stamp:
+        _probes[path] = (stamp, build_probe(parse_probe_file(path)))
+    return _probes[path][1]
+
+
+def kwik_probe(kwik):
+    """the probe model stored in the channel groups of an open kwik file,
+    rebuilt only when the file has been modified"""
+    path = os.path.abspath(kwik.filename)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    key = ('kwik', path)
+    if key not in _probes or _probes[key][0] != stamp:
+        shanks = {}
+        for name, group in kwik['channel_groups'].items():
+            positions = {int(c): group['channels'][c].attrs['position']
+                         for c in group['channels']}
+            if 'channel_order' in group.attrs:
+                order = [int(c) for c in group.attrs['channel_order']]
+            else:
+                order = sorted(positions)
+            shanks[int(name)] = (order, [], positions)
+        _probes[key] = (stamp, build_probe(shanks))
+    return _probes[key][1]
+
+
+def channel_index(probe, channels):
+    """positions of CHANNELS in the probe arrays"""
+    return np.searchsorted(probe['channels'], channels)
+
+
+def shank_channels(probe, shank):
+    """channel numbers of SHANK, in probe order"""
+    i = np.flatnonzero(probe['shank_ids'] == shank)
+    if not len(i):
+        return np.zeros(0, dtype=int)
+    offsets = probe['shank_offsets']
+    return probe['channel_order'][offsets[i[0]]:offsets[i[0] + 1]]
+
+
+def shank_sizes(probe):
+    """{shank: number of channels}"""
+    return dict(zip(probe['shank_ids'].tolist(),
+                    np.diff(probe['shank_offsets']).tolist()))
+
+
+def geometry_dict(probe):
+    """{channel: (x, y)} of the channels with a known position"""
+    known = ~np.isnan(probe['positions']).any(axis=1)
+    return {int(c): tuple(xy) for c, xy in
+            zip(probe['channels'][known], probe['positions'][known])}
+
+
+def geometry_table(probe, channels=None):
+    """an Nelectrode by 3 array of channel number, x and y, sorted by
+    channel, for CHANNELS or all channels"""
+    if channels is None:
+        channels = probe['channels']
+    channels = np.sort(channels)
+    return np.column_stack((channels,
+                            probe['positions'][channel_index(probe, channels)]))
+
+
+def neighbors(probe, channels, radius=None):
+    """boolean (len(CHANNELS), all channels) array, true for the neighbors
+    of each of CHANNELS: adjacent in the probe graph, or, with RADIUS, on
+    the same shank and closer than RADIUS"""
+    i = channel_index(probe, channels)
+    if radius is None:
+        return probe['adjacency'][i]
+    xy = probe['positions']
+    dist = np.sqrt(((xy[i][:, None, :] - xy[None, :, :]) ** 2).sum(axis=2))
+    near = np.logical_and(dist <= radius,
+                          probe['shank'][i][:, None] == probe['shank'][None, :])
+    near[np.arange(len(i)), i] = False
+    return near
+
+
+def nearest_channels(probe, channel, n):
+    """the N channels of CHANNEL's shank closest to it, itself first"""
+    i = channel_index(probe, [channel])[0]
+    same = np.flatnonzero(probe['shank'] == probe['shank'][i])
+    dist = ((probe['positions'][same] - probe['positions'][i]) ** 2).sum(axis=1)
+    return probe['channels'][same[np.argsort(dist, kind='mergesort')[:n]]]
@@ -0,0 +1,32 @@
+import os
+import numpy as np
+
+
+def load_sidecar(filename, stamp):
+    """arrays saved by save_sidecar in FILENAME, or None if the file does
+    not exist, was saved with another STAMP, or cannot be read"""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as f:
+            if not np.array_equal(f['stamp'], stamp):
+                return None
+            return {k: f[k] for k in f.files if k != 'stamp'}
+    except Exception:
+        # a damaged file is rebuilt like a stale one
+        return None
+
+
+def save_sidecar(filename, stamp, arrays):
+    """saves the dictionary ARRAYS and STAMP to FILENAME, an .npz file,
+    through a temporary file renamed into place so that readers never see a
+    partial file. Failing to write, eg in a read only directory, is not an
+    error: the arrays are simply not cached"""
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, stamp=stamp, **arrays)
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,109 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import arf2kwd
+from benchmark import make_arf
+
+
+def make_int16_arf(filename, nentries, nchannels, nsamples, scale=None,
+                   seed=0):
+    """arf file of int16 extracellular channels, with a 'scale' attribute
+    if SCALE is given"""
+    rng = np.random.RandomState(seed)
+    with h5py.File(filename, 'w') as f:
+        for e in range(nentries):
+            entry = f.create_group('e{:03d}'.format(e))
+            entry.attrs['timestamp'] = np.array([e, 0])
+            for c in range(nchannels):
+                dset = entry.create_dataset(
+                    'A-{:03d}'.format(c),
+                    data=rng.randint(-2000, 2000, nsamples).astype('i2'))
+                dset.attrs['datatype'] = 3
+                dset.attrs['sampling_rate'] = 30000
+                if scale is not None:
+                    dset.attrs['scale'] = scale
+
+
+def kwd_data(kwd_name):
+    with h5py.File(kwd_name, 'r') as f:
+        return [f['recordings'][r]['data'][()]
+                for r in sorted(f['recordings'], key=int)]
+
+
+class TestArf2kwd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def convert(self, source, name, **kwargs):
+        """converts a copy of SOURCE named NAME, returns the kwd data"""
+        shutil.copy(source, self.path(name))
+        return kwd_data(arf2kwd.main(self.path(name), verbose=False,
+                                     **kwargs))
+
+    def assert_same(self, a, b):
+        self.assertEqual(len(a), len(b))
+        for x, y in zip(a, b):
+            self.assertEqual(x.dtype, np.int16)
+            np.testing.assert_array_equal(x, y)
+
+    def test_parallel_matches_serial(self):
+        make_arf(self.path('src.arf'), 3, 5, 1.5)
+        serial = self.convert(self.path('src.arf'), 'serial.arf')
+        # small chunks split every entry into many blocks
+        chunk_bytes, arf2kwd.CHUNK_BYTES = arf2kwd.CHUNK_BYTES, 2**14
+        try:
+            parallel = self.convert(self.path('src.arf'), 'parallel.arf',
+                                    memory=0.5, jobs=3)
+        finally:
+            arf2kwd.CHUNK_BYTES = chunk_bytes
+        with h5py.File(self.path('parallel.raw.kwd'), 'r') as f:
+            data = f['recordings']['0']['data']
+            self.assertLess(arf2kwd.block_rows(5, 2**19 // 6, data.chunks[0]),
+                            len(data))
+        self.assert_same(serial, parallel)
+        with h5py.File(self.path('src.arf'), 'r') as f:
+            np.testing.assert_array_equal(
+                serial[2][:, 4], np.round(f['e002']['A-004'][()] / 0.195))
+
+    def test_virtual_matches_copy(self):
+        make_int16_arf(self.path('src.arf'), 3, 4, 5000,
+                       scale=arf2kwd.KWD_SCALE)
+        copied = self.convert(self.path('src.arf'), 'copy.arf')
+        linked = self.convert(self.path('src.arf'), 'virtual.arf',
+                              virtual=True)
+        self.assert_same(copied, linked)
+        with h5py.File(self.path('src.arf'), 'r') as f:
+            np.testing.assert_array_equal(copied[1][:, 2], f['e001']['A-002'])
+        with h5py.File(self.path('virtual.raw.kwd'), 'r') as f:
+            self.assertTrue(f['recordings']['0']['data'].is_virtual)
+
+    def test_virtual_unscaled_int16_is_copied(self):
+        make_int16_arf(self.path('src.arf'), 2, 3, 5000)
+        copied = self.convert(self.path('src.arf'), 'copy.arf')
+        linked = self.convert(self.path('src.arf'), 'virtual.arf',
+                              virtual=True)
+        self.assert_same(copied, linked)
+        with h5py.File(self.path('src.arf'), 'r') as f:
+            np.testing.assert_array_equal(
+                copied[0][:, 1], np.round(f['e000']['A-001'][()] / 0.195))
+        with h5py.File(self.path('virtual.raw.kwd'), 'r') as f:
+            self.assertFalse(f['recordings']['0']['data'].is_virtual)
+
+
+if __name__ == '__main__':
+    unittest.main()
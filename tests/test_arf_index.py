@@ -0,0 +1,91 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from arf_index import (build_index, get_index, update_index, index_datasets,
+                       index_filename)
+from benchmark import make_arf
+
+
+class TestArfIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.arf_name = os.path.join(self.tmp, 'index.arf')
+        make_arf(self.arf_name, 3, 2, 0.1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assert_same_index(self, a, b):
+        self.assertEqual(sorted(a), sorted(b))
+        for key in a:
+            np.testing.assert_array_equal(a[key], b[key])
+
+    def test_datasets(self):
+        with h5py.File(self.arf_name, 'r') as f:
+            index = get_index(f, cache=False)
+        self.assertEqual(list(index['entries']), ['e000', 'e001', 'e002'])
+        self.assertEqual(index_datasets(index, 'e001', (3,)),
+                         ['A-000', 'A-001'])
+        self.assertEqual(index_datasets(index, 'e001', (23,)), [])
+        self.assertEqual(index_datasets(index, 'e001', (23,), name='001'),
+                         ['A-001'])
+        np.testing.assert_array_equal(index['entry_offsets'],
+                                      [0, 3000, 6000, 9000])
+
+    def test_writable_handle(self):
+        with h5py.File(self.arf_name, 'r+') as f:
+            index = get_index(f)
+            self.assertIs(get_index(f), index)
+            self.assertIs(get_index(f['e001'].file), index)
+            # a new entry, a new dataset in an entry and a deleted entry
+            f.create_group('e003').attrs['timestamp'] = np.array([9, 0])
+            dset = f['e003'].create_dataset('A-000', data=np.zeros(10))
+            dset.attrs['datatype'] = 3
+            f['e000'].create_dataset('labels', data=np.zeros(4))
+            del f['e002']
+            update_index(f, ['e000', 'e002', 'e003'])
+            self.assert_same_index(get_index(f), build_index(f))
+            self.assertEqual(index_datasets(get_index(f), 'e000'),
+                             ['A-000', 'A-001', 'labels'])
+        # another handle on the file gets a new index
+        with h5py.File(self.arf_name, 'r+') as f:
+            self.assertIsNot(get_index(f), index)
+            self.assertEqual(list(get_index(f)['entries']),
+                             ['e000', 'e001', 'e003'])
+
+    def test_read_only_cache(self):
+        with h5py.File(self.arf_name, 'r') as f:
+            index = get_index(f)
+        with h5py.File(self.arf_name, 'r') as f:
+            self.assertIs(get_index(f), index)
+        with h5py.File(self.arf_name, 'r+') as f:
+            f['e000'].create_dataset('labels', data=np.zeros(4))
+        with h5py.File(self.arf_name, 'r') as f:
+            self.assertIn('labels', index_datasets(get_index(f), 'e000'))
+
+    def test_damaged_cache(self):
+        with h5py.File(self.arf_name, 'r') as f:
+            expected = build_index(f)
+        sidecar = index_filename(self.arf_name)
+        with open(sidecar, 'wb') as f:
+            f.write(b'PK\x03\x04 truncated')
+        with h5py.File(self.arf_name, 'r') as f:
+            self.assert_same_index(get_index(f), expected)
+        # the damaged file was replaced by a complete one
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         sorted(['index.arf', os.path.basename(sidecar)]))
+        with np.load(sidecar) as f:
+            np.testing.assert_array_equal(f['entries'], expected['entries'])
+
+
+if __name__ == '__main__':
+    unittest.main()
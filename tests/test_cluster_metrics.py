@@ -0,0 +1,53 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import cluster_metrics
+from benchmark import make_kwik
+
+
+class TestFirstPass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'sorted')
+        make_kwik(self.base, 1, 5, 2000, 3, 1., nsamples=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_sums(self):
+        with h5py.File(self.base + '.kwik', 'r') as kwik, \
+                h5py.File(self.base + '.kwx', 'r') as kwx:
+            labels = kwik['channel_groups/0/spikes/clusters/main'][:]
+            waves = kwx['channel_groups/0/waveforms_filtered']
+            features = kwx['channel_groups/0/features_masks']
+            (amplitudes, wave_sums, wave_squares, feat_sums,
+             feat_outer) = cluster_metrics.first_pass(waves, features, labels,
+                                                      5, 600)
+            w = waves[:].astype(float).reshape(len(labels), -1)
+            f = features[:, :, 0].astype(float)
+        np.testing.assert_allclose(amplitudes,
+                                   (w.reshape(-1, 8, 3).max(axis=1)
+                                    - w.reshape(-1, 8, 3).min(axis=1))
+                                   .max(axis=1))
+        for k in range(5):
+            member = labels == k
+            np.testing.assert_allclose(wave_sums[k], w[member].sum(axis=0))
+            np.testing.assert_allclose(wave_squares[k],
+                                       (w[member] ** 2).sum(axis=0))
+            np.testing.assert_allclose(feat_sums[k], f[member].sum(axis=0),
+                                       rtol=1e-6)
+            np.testing.assert_allclose(feat_outer[k],
+                                       f[member].T.dot(f[member]), rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from scipy.signal import filtfilt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import dumber_sums
+
+SAMPLING_RATE = 30000
+
+
+def labels(starts, names):
+    stimuli = np.zeros(len(starts), dtype=[('start', int), ('name', 'S8')])
+    stimuli['start'] = starts
+    stimuli['name'] = names
+    return stimuli
+
+
+class TestStimulusEnvelopes(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.datasets = [rng.randn(4 * SAMPLING_RATE) * (c + 1)
+                         for c in range(3)]
+
+    def test_matches_whole_channel_filtering(self):
+        stimuli = labels([20000, 33000, 70000, 95000],
+                         [b'a', b'b', b'a', b'b'])
+        lengths = {b'a': 9000, b'b': 4500}
+        step = 30
+        responses, times = dumber_sums.stimulus_envelopes(
+            self.datasets, stimuli, lengths, SAMPLING_RATE, 0.25, step,
+            block_duration=0.2)
+        hb, ha, lb, la = dumber_sums.envelope_filters(SAMPLING_RATE)
+        full = np.array([filtfilt(lb, la, np.abs(filtfilt(hb, ha, x)))
+                         for x in self.datasets])
+        buffer_samples = int(0.25 * SAMPLING_RATE)
+        for name, length in lengths.items():
+            nsamples = (2 * buffer_samples + length) // step
+            starts = stimuli['start'][stimuli['name'] == name] - buffer_samples
+            expected = np.array([full[:, s // step * step
+                                      + np.arange(nsamples) * step]
+                                 for s in starts])
+            self.assertEqual(responses[name].shape, expected.shape)
+            np.testing.assert_allclose(responses[name], expected,
+                                       atol=1e-3 * np.abs(full).max())
+            self.assertEqual(len(times[name]), nsamples)
+            self.assertAlmostEqual(times[name][0], -0.25)
+
+    def test_no_stimuli(self):
+        responses, times = dumber_sums.stimulus_envelopes(
+            self.datasets, labels([], []), {}, SAMPLING_RATE)
+        self.assertEqual(responses, {})
+        responses, times = dumber_sums.stimulus_envelopes(
+            self.datasets, labels([], []), {b'a': 9000}, SAMPLING_RATE)
+        self.assertEqual(responses[b'a'].shape, (0, 3, 1300))
+
+
+class TestSummaryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'sums.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        names = [u'song', u'bos', u'rev']
+        means = {name: rng.randn(3, 10) for name in names}
+        variances = {name: rng.rand(3, 10) for name in names}
+        times = {name: np.arange(10) / 1000. for name in names}
+        counts = {u'song': 4, u'bos': 0, u'rev': 7}
+        dumber_sums.save_summary(self.cache, 'abc123', means, variances,
+                                 times, counts)
+        self.assertIsNone(dumber_sums.load_summary(self.cache, 'other'))
+        loaded = dumber_sums.load_summary(self.cache, 'abc123')
+        for saved, read in zip((means, variances, times, counts), loaded):
+            self.assertEqual(sorted(read), sorted(names))
+            for name in read:
+                self.assertIsInstance(name, type(u''))
+                np.testing.assert_array_equal(read[name], saved[name])
+
+    def test_missing(self):
+        self.assertIsNone(dumber_sums.load_summary(self.cache, 'abc123'))
+        self.assertIsNone(dumber_sums.load_summary(None, 'abc123'))
+
+
+if __name__ == '__main__':
+    unittest.main()
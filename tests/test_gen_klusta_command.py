@@ -0,0 +1,163 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+from math import ceil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+import gen_klusta_command as gkc
+from benchmark import make_kwik
+
+
+class TestCountSpikes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_clu(self, shank, nspikes):
+        with open(os.path.join(self.tmp, 'base.clu.{}'.format(shank)),
+                  'w') as f:
+            f.write('12\n')
+            for i in range(nspikes):
+                f.write('{}\n'.format(i % 12))
+
+    def test_kwik(self):
+        make_kwik(os.path.join(self.tmp, 'base'), 2, 3, 1234, 2, 1.,
+                  nsamples=4)
+        self.assertEqual(gkc.count_spikes('base', self.tmp, 1), 1234)
+
+    def test_clu(self):
+        self.write_clu(2, 500)
+        self.assertEqual(gkc.count_spikes('base', self.tmp, 2), 500)
+
+    def test_clu_estimate(self):
+        # only the first 1000 bytes are read, the rest is extrapolated
+        self.write_clu(3, 20000)
+        estimate = gkc.count_spikes('base', self.tmp, 3, sample_bytes=1000)
+        self.assertLess(abs(estimate - 20000), 20000 * 0.1)
+
+
+class TestResources(unittest.TestCase):
+
+    def test_read_prm(self):
+        self.assertEqual(gkc.read_prm(os.path.join(ROOT, 'EXAMPLE.prm')),
+                         {'nchannels': 32, 'nfeatures_per_channel': 3,
+                          'MaxPossibleClusters': 500})
+
+    def test_estimate_resources(self):
+        memory, seconds = gkc.estimate_resources(10**6, 8, 1)
+        nfeatures = 8 * 3 + 1
+        self.assertEqual(memory, gkc.BASE_MEMORY + gkc.BYTES_PER_FLOAT
+                         * (10**6 * 3 * nfeatures + 10**6 * 64))
+        self.assertAlmostEqual(seconds, gkc.SECONDS_PER_UNIT * 10**6
+                               * nfeatures * 64)
+        sub_memory, sub_seconds = gkc.estimate_resources(10**6, 8, 4)
+        self.assertLess(sub_memory, memory)
+        self.assertAlmostEqual(sub_seconds, seconds / 4)
+
+    def test_tune_subset_without_budget(self):
+        factor, maxclusters, memory, seconds = gkc.tune_subset(
+            2500000, 8, max_spikes=800000)
+        self.assertEqual(factor, int(ceil(2500000 / 800000.)))
+        self.assertEqual(maxclusters, 64)
+        self.assertEqual((memory, seconds),
+                         gkc.estimate_resources(2500000, 8, factor, 3, 64))
+
+    def test_tune_subset_budget(self):
+        nspikes = 2000000
+        factor, maxclusters, memory, seconds = gkc.tune_subset(
+            nspikes, 8, max_spikes=nspikes, max_seconds=5.)
+        self.assertGreater(factor, 1)
+        self.assertLessEqual(seconds, 5.)
+        self.assertEqual(maxclusters, 64)
+        memory_budget = gkc.estimate_resources(nspikes, 8, 4)[0]
+        factor, maxclusters, memory, seconds = gkc.tune_subset(
+            nspikes, 8, max_spikes=nspikes, max_memory=memory_budget)
+        self.assertEqual(factor, 4)
+        self.assertLessEqual(memory, memory_budget)
+
+    def test_tune_subset_lowers_clusters(self):
+        # a budget this small leaves too few spikes per cluster, so the
+        # number of clusters is lowered, but not below 3 per channel
+        factor, maxclusters, memory, seconds = gkc.tune_subset(
+            100000, 8, max_spikes=100000, max_seconds=0.01)
+        self.assertLess(maxclusters, 64)
+        self.assertGreaterEqual(maxclusters, 24)
+
+
+class TestJobArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        make_kwik(os.path.join(self.tmp, 'base'), 4, 3, 1000, 8, 1.,
+                  nsamples=4)
+        self.plan = gkc.plan_shanks('base', self.tmp,
+                                    os.path.join(ROOT, 'probefiles',
+                                                 'A4x8-50.prb'),
+                                    max_spikes=300,
+                                    max_memory=2**30)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, name):
+        with open(os.path.join(self.tmp, name)) as f:
+            return f.read().splitlines()
+
+    def test_plan_shanks(self):
+        self.assertEqual(sorted(job['shank'] for job in self.plan),
+                         [0, 1, 2, 3])
+        seconds = [job['seconds'] for job in self.plan]
+        self.assertEqual(seconds, sorted(seconds, reverse=True))
+        for job in self.plan:
+            self.assertEqual(job['nchannels'], 8)
+            self.assertEqual(job['nspikes'], 1000)
+            self.assertEqual(job['subset'], 4)
+            self.assertEqual(job['args'][:3],
+                             ['MaskedKlustaKwik', 'base', str(job['shank'])])
+            self.assertIn('-MaxPossibleClusters', job['args'])
+
+    def test_job_array(self):
+        submit = gkc.write_job_array('base', self.tmp, self.plan, 'beast',
+                                     after='kwik2arf base.kwik')
+        self.assertEqual(submit, os.path.join(self.tmp, 'base.submit.sh'))
+        lines = self.read('base.submit.sh')
+        self.assertEqual(lines[:2], ['#!/bin/sh', 'JOBS=""'])
+        self.assertEqual(lines[2:-1],
+                         ['JOBS="$JOBS:$(qsub base.{}.sh)"'.format(job['shank'])
+                          for job in self.plan])
+        self.assertEqual(lines[-1], "echo 'kwik2arf base.kwik' | qsub "
+                         "-N base_after -W depend=afterok$JOBS")
+        for job in self.plan:
+            script = self.read('base.{}.sh'.format(job['shank']))
+            self.assertIn('#PBS -N base{}'.format(job['shank']), script)
+            self.assertIn('#PBS -l mem={}mb'.format(
+                int(ceil(job['memory'] / 2.**20))), script)
+            self.assertEqual(script[-2:], ['cd $PBS_O_WORKDIR',
+                                           ' '.join(job['args'])])
+
+    def test_job_array_without_after(self):
+        gkc.write_job_array('base', self.tmp, self.plan, 'beast')
+        lines = self.read('base.submit.sh')
+        self.assertEqual(len(lines), 2 + len(self.plan))
+        self.assertNotIn('afterok', '\n'.join(lines))
+
+    def test_local_scripts(self):
+        scripts = gkc.write_job_array('base', self.tmp, self.plan, False)
+        self.assertEqual(len(scripts), 4)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp,
+                                                     'base.submit.sh')))
+        for job, script in zip(self.plan, scripts):
+            with open(script) as f:
+                self.assertEqual(f.read(), ' '.join(job['args']) + '\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import klusta_runner
+
+
+class TestSessionJobs(unittest.TestCase):
+
+    def test_prm_without_probe(self):
+        jobs = klusta_runner.session_jobs('/data/bird/session.prm', None)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['args'], ['klusta', 'session.prm'])
+        self.assertEqual(jobs[0]['cwd'], '/data/bird')
+
+    def test_file_base_needs_probe(self):
+        with self.assertRaises(ValueError):
+            klusta_runner.session_jobs('/data/bird/session', None)
+
+
+
+class TestRunJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp, 'state.json')
+        self.history_file = os.path.join(self.tmp, 'history.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def job(self, name, args, memory=100, seconds=1):
+        return {'name': name, 'cwd': self.tmp, 'args': args,
+                'memory': memory, 'seconds': seconds}
+
+    def run_jobs(self, jobs, **kwargs):
+        return klusta_runner.run_jobs(jobs, self.state_file,
+                                      history_file=self.history_file,
+                                      poll=0.01, **kwargs)
+
+    def history(self):
+        return klusta_runner.read_history(self.history_file)
+
+    def test_done_and_failed(self):
+        jobs = [self.job('ok', ['true']), self.job('bad', ['false'])]
+        state = self.run_jobs(jobs)
+        self.assertEqual(state['ok']['status'], 'done')
+        self.assertEqual(state['ok']['returncode'], 0)
+        self.assertEqual(state['bad']['status'], 'failed')
+        self.assertEqual(state['bad']['returncode'], 1)
+        self.assertEqual(state['bad']['log'],
+                         os.path.join(self.tmp, 'bad.log'))
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), state)
+        history = {r['name']: r for r in self.history()}
+        self.assertEqual(sorted(history), ['bad', 'ok'])
+        self.assertEqual(history['bad']['returncode'], 1)
+        self.assertEqual(history['ok']['memory'], 100)
+
+    def test_resume(self):
+        self.run_jobs([self.job('ok', ['true']), self.job('bad', ['false'])])
+        # the done job is skipped, the failed one runs again
+        marker = os.path.join(self.tmp, 'ran')
+        state = self.run_jobs([self.job('ok', ['touch', marker]),
+                               self.job('bad', ['true'])])
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(state['bad']['status'], 'done')
+        self.assertEqual(sorted(r['name'] for r in self.history()),
+                         ['bad', 'bad', 'ok'])
+
+    def test_memory_gate(self):
+        # each job fails if another one holds the lock, so they only
+        # succeed if the memory budget keeps them from running together
+        script = 'test ! -e lock && touch lock && sleep 0.2 && rm lock'
+        jobs = [self.job(name, ['sh', '-c', script], memory=80)
+                for name in ('a', 'b')]
+        state = self.run_jobs(jobs, cores=2, memory=100)
+        self.assertEqual(state['a']['status'], 'done')
+        self.assertEqual(state['b']['status'], 'done')
+
+    def test_job_larger_than_memory(self):
+        # a job above the budget still runs when nothing else is running
+        state = self.run_jobs([self.job('big', ['true'], memory=1000)],
+                              memory=100)
+        self.assertEqual(state['big']['status'], 'done')
+
+
+class TestCalibration(unittest.TestCase):
+
+    def test_no_history(self):
+        self.assertEqual(klusta_runner.calibration([]), (1., 1.))
+
+    def test_median_ratios(self):
+        history = [{'returncode': 0, 'memory': 100, 'seconds': 10,
+                    'peak_rss': rss, 'wall_time': wall}
+                   for rss, wall in ((50, 10), (200, 30), (150, 20))]
+        # failed jobs are left out
+        history.append({'returncode': 1, 'memory': 100, 'seconds': 10,
+                        'peak_rss': 1000, 'wall_time': 1000})
+        self.assertEqual(klusta_runner.calibration(history), (1.5, 2.))
+
+
+if __name__ == '__main__':
+    unittest.main()
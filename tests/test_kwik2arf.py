@@ -0,0 +1,97 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+import arf
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import kwik2arf
+from benchmark import make_arf, make_old_kwik
+
+
+def file_contents(filename):
+    """every dataset of an hdf5 file by path, and its root attributes"""
+    contents = {}
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            contents[name] = obj[()]
+    with h5py.File(filename, 'r') as f:
+        f.visititems(visit)
+        attrs = dict(f.attrs)
+    return contents, attrs
+
+
+class TestKwik2arf(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.arf_name = self.path('raw.arf')
+        self.kwik_name = self.path('sorted.kwik')
+        make_arf(self.arf_name, 3, 2, 0.5)
+        make_old_kwik(self.kwik_name, 2, 6, 3000, 2, 1.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def export(self, out_name, arf_names=None):
+        with h5py.File(self.kwik_name, 'r') as kwik_file, \
+                arf.open_file(out_name, 'w') as spikes_file:
+            kwik2arf.merge(kwik_file, arf_names or [self.arf_name],
+                           spikes_file, verbose=False)
+
+    def recurate(self, shank):
+        """moves spikes of cluster 0 to cluster 7 and changes the group of
+        cluster 1 in SHANK"""
+        with h5py.File(self.kwik_name, 'r+') as kwik_file:
+            group = kwik_file['shanks'][shank]
+            spikes = group['spikes'][:]
+            spikes['cluster_manual'][spikes['cluster_manual'] == 0] = 7
+            group['spikes'][:] = spikes
+            clusters = group['clusters'][:]
+            clusters['group'][clusters['cluster'] == 1] = 0
+            group['clusters'][:] = clusters
+
+    def test_update_matches_export(self):
+        self.export(self.path('updated.arf'))
+        self.recurate('shank1')
+        with h5py.File(self.kwik_name, 'r') as kwik_file, \
+                arf.open_file(self.path('updated.arf'), 'r+') as spikes_file:
+            self.assertEqual(kwik2arf.update_spikes(kwik_file, spikes_file,
+                                                    verbose=False), [2])
+        self.export(self.path('fresh.arf'))
+        updated, updated_attrs = file_contents(self.path('updated.arf'))
+        fresh, fresh_attrs = file_contents(self.path('fresh.arf'))
+        self.assertEqual(sorted(updated), sorted(fresh))
+        self.assertIn('e001/spikes_2', fresh)
+        for name in fresh:
+            np.testing.assert_array_equal(updated[name], fresh[name])
+        self.assertEqual(updated_attrs['kwik_digests'],
+                         fresh_attrs['kwik_digests'])
+
+    def test_update_without_changes(self):
+        self.export(self.path('updated.arf'))
+        with h5py.File(self.kwik_name, 'r') as kwik_file, \
+                arf.open_file(self.path('updated.arf'), 'r+') as spikes_file:
+            self.assertEqual(kwik2arf.update_spikes(kwik_file, spikes_file,
+                                                    verbose=False), [])
+
+    def test_merge_entry_clash(self):
+        shutil.copy(self.arf_name, self.path('again.arf'))
+        with self.assertRaises(ValueError):
+            self.export(self.path('merged.arf'),
+                        [self.arf_name, self.path('again.arf')])
+        with h5py.File(self.path('merged.arf'), 'r') as f:
+            self.assertEqual(len(f), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import kwik_utils
+from benchmark import make_kwik
+
+
+class TestPsth(unittest.TestCase):
+
+    def test_counts_match_histogram(self):
+        rng = np.random.RandomState(0)
+        sampling_rate = 30000
+        starts_list = [np.array([100000, 400000]), np.array([250000])]
+        # spikes on every bin edge, plus random ones
+        on_edges = np.concatenate([s + np.arange(-60000, 120001, 300)
+                                   for s in np.concatenate(starts_list)])
+        spike_times_list = [np.sort(np.concatenate(
+            (on_edges, rng.randint(0, 600000, 5000)))),
+            np.sort(rng.randint(0, 600000, 3000))]
+        counts, edges, ntrials = kwik_utils.psth_counts(
+            spike_times_list, starts_list, sampling_rate, -2, 4, 0.01)
+        sample_edges = np.round(edges * sampling_rate).astype(int)
+        np.testing.assert_array_equal(sample_edges,
+                                      np.arange(-60000, 120001, 300))
+        np.testing.assert_array_equal(ntrials, [2, 1])
+        for i, spike_times in enumerate(spike_times_list):
+            for j, starts in enumerate(starts_list):
+                expected = sum(np.histogram(spike_times - start,
+                                            sample_edges)[0]
+                               for start in starts)
+                np.testing.assert_array_equal(counts[i, j], expected)
+        # every edge holds a spike of each trial, the last bin two
+        self.assertTrue(np.all(counts[0, 0, :-1] >= 2))
+        self.assertTrue(counts[0, 0, -1] >= 4)
+
+
+class TestSpikeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'sorted')
+        make_kwik(self.base, 1, 5, 1000, 2, 1., nsamples=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cached_index(self):
+        with h5py.File(self.base + '.kwik', 'r') as kwik:
+            shank = kwik['channel_groups']['0']
+            expected = kwik_utils.build_spike_index(shank)
+            filename = kwik_utils.spike_index_filename(shank)
+            with open(filename, 'wb') as f:
+                f.write(b'PK\x03\x04 truncated')
+            for i in range(2):  # rebuilt, then read from the cache
+                index = kwik_utils.get_spike_index(shank)
+                self.assertEqual(sorted(index), sorted(expected))
+                for key in expected:
+                    np.testing.assert_array_equal(index[key], expected[key])
+            times = kwik_utils.get_spike_times(shank)[:]
+            clusters = kwik_utils.get_spike_cluster(shank)[:]
+        np.testing.assert_array_equal(
+            np.sort(kwik_utils.index_cluster_times(index, 3)),
+            np.sort(times[clusters == 3]))
+        self.assertFalse([f for f in os.listdir(self.tmp)
+                          if f.endswith('.tmp')])
+
+
+class TestWaveformStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'sorted')
+        make_kwik(self.base, 1, 7, 3000, 4, 1., nsamples=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_add_by_label(self):
+        rng = np.random.RandomState(0)
+        labels = rng.randint(0, 5, 200)
+        labels[labels == 3] = 4  # a label without rows
+        values = rng.randn(200, 6)
+        out = kwik_utils.add_by_label(np.ones((5, 6)), labels, values)
+        expected = np.ones((5, 6))
+        for label, row in zip(labels, values):
+            expected[label] += row
+        np.testing.assert_allclose(out, expected)
+
+    def test_cluster_waveform_stats(self):
+        with h5py.File(self.base + '.kwik', 'r') as kwik, \
+                h5py.File(self.base + '.kwx', 'r') as kwx:
+            shank = kwik['channel_groups']['0']
+            kwx_shank = kwx['channel_groups']['0']
+            stats = kwik_utils.cluster_waveform_stats(kwx_shank, shank,
+                                                      block_rows=700,
+                                                      cache=False)
+            clusters = kwik_utils.get_spike_cluster(shank)[:]
+            waves = kwik_utils.get_spike_waveforms(kwx_shank)[:].astype(float)
+        np.testing.assert_array_equal(stats['clusters'], np.arange(7))
+        for i, cluster in enumerate(stats['clusters']):
+            w = waves[clusters == cluster]
+            self.assertEqual(stats['counts'][i], len(w))
+            np.testing.assert_allclose(stats['mean'][i], w.mean(axis=0))
+            np.testing.assert_allclose(stats['std'][i], w.std(axis=0),
+                                       rtol=1e-6)
+
+
+    def test_cached_stats(self):
+        with h5py.File(self.base + '.kwik', 'r') as kwik, \
+                h5py.File(self.base + '.kwx', 'r') as kwx:
+            shank = kwik['channel_groups']['0']
+            kwx_shank = kwx['channel_groups']['0']
+            expected = kwik_utils.cluster_waveform_stats(kwx_shank, shank,
+                                                         cache=False)
+            with open(kwik_utils.wave_stats_filename(shank), 'wb') as f:
+                f.write(b'PK\x03\x04 truncated')
+            for i in range(2):  # rebuilt, then read from the cache
+                stats = kwik_utils.cluster_waveform_stats(kwx_shank, shank)
+                for key in expected:
+                    np.testing.assert_array_equal(stats[key], expected[key])
+
+if __name__ == '__main__':
+    unittest.main()
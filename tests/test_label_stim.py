@@ -0,0 +1,96 @@
+import imp
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from scipy.fftpack import next_fast_len
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+label_stim = imp.load_source('label_stim', os.path.join(ROOT, 'label_stim'))
+from benchmark import make_stimuli, make_arf
+
+
+def correlate_scores(stimuli, copies):
+    """maximum cross-correlation of each copy with each stimulus"""
+    return np.array([[np.correlate(stim, copy, 'full').max()
+                      for stim in stimuli] for copy in copies])
+
+
+class TestClassifyStim(unittest.TestCase):
+
+    def check_scores(self, stim_length, jobs=1):
+        rng = np.random.RandomState(0)
+        stimuli = [rng.randn(stim_length) for i in range(3)]
+        copies = [stimuli[i][:stim_length - 7] + rng.randn(stim_length - 7)
+                  for i in (2, 0, 1, 2)]
+        stim_idx, scores = label_stim.classify_stim(stimuli, copies,
+                                                    jobs=jobs)
+        np.testing.assert_allclose(scores, correlate_scores(stimuli, copies),
+                                   rtol=1e-9, atol=1e-9)
+        np.testing.assert_array_equal(stim_idx, [2, 0, 1, 2])
+
+    def test_odd_nfft(self):
+        # 563 + 556 - 1 samples need an fft of 1125 points
+        self.assertEqual(next_fast_len(563 + 556 - 1) % 2, 1)
+        self.check_scores(563)
+
+    def test_even_nfft(self):
+        self.assertEqual(next_fast_len(600 + 593 - 1) % 2, 0)
+        self.check_scores(600)
+
+    def test_odd_nfft_parallel(self):
+        self.check_scores(563, jobs=2)
+
+
+class TestLabelStim(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.wavenames, stimuli = make_stimuli(self.tmp, 3, duration=0.1)
+        self.stim_labels = ['stim{}'.format(i) for i in range(3)]
+        self.arf_name = os.path.join(self.tmp, 'labels.arf')
+        self.expected = make_arf(self.arf_name, 6, 0, 2., stimuli, 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def labels(self, arf_name):
+        with h5py.File(arf_name, 'r') as f:
+            return [f[entry]['stimulus_time'][()] for entry in sorted(f)
+                    if entry != 'stimuli']
+
+    def test_parallel_cold_cache(self):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        serial_name = os.path.join(self.tmp, 'serial.arf')
+        shutil.copy(self.arf_name, serial_name)
+        label_stim.label_stim(self.arf_name, self.wavenames, self.stim_labels,
+                              'pulse', 'copy', jobs=4,
+                              template_cache_dir=cache_dir)
+        label_stim.label_stim(serial_name, self.wavenames, self.stim_labels,
+                              'pulse', 'copy')
+        parallel, serial = self.labels(self.arf_name), self.labels(serial_name)
+        self.assertEqual(len(parallel), len(self.expected))
+        for labels, expected, serial_labels in zip(parallel, self.expected,
+                                                   serial):
+            np.testing.assert_array_equal(labels['name'], expected['name'])
+            np.testing.assert_array_equal(labels, serial_labels)
+        # one complete file per stimulus
+        self.assertEqual(sorted(os.path.splitext(f)[1]
+                                for f in os.listdir(cache_dir)),
+                         ['.npy'] * 3)
+        # a second run reads the cached templates
+        label_stim.label_stim(self.arf_name, self.wavenames, self.stim_labels,
+                              'pulse', 'copy', jobs=4,
+                              template_cache_dir=cache_dir)
+        for labels, serial_labels in zip(self.labels(self.arf_name), serial):
+            np.testing.assert_array_equal(labels, serial_labels)
+
+
+if __name__ == '__main__':
+    unittest.main()
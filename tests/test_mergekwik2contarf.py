@@ -0,0 +1,86 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import mergekwik2contarf
+from benchmark import make_kwik
+
+
+def entry_contents(arf_name, entry_name='spikes'):
+    with h5py.File(arf_name, 'r') as f:
+        entry = f[entry_name]
+        return {name: entry[name][()] for name in entry}
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'sorted')
+        make_kwik(self.base, 3, 6, 2500, 4, 2., nsamples=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def export(self, arf_name, jobs):
+        mergekwik2contarf.main(self.base + '.kwik', self.base + '.kwx',
+                               arf_name, timestamp=0, jobs=jobs,
+                               verbose=False)
+        return entry_contents(arf_name)
+
+    def test_parallel_matches_serial(self):
+        serial = self.export(os.path.join(self.tmp, 'serial.arf'), 1)
+        parallel = self.export(os.path.join(self.tmp, 'parallel.arf'), 3)
+        self.assertEqual(sorted(serial), sorted(parallel))
+        self.assertIn('waves_2', serial)
+        for name in serial:
+            np.testing.assert_array_equal(serial[name], parallel[name])
+        # no temporary files are left
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['parallel.arf', 'serial.arf', 'sorted.kwik',
+                          'sorted.kwx'])
+
+    def test_matches_source(self):
+        exported = self.export(os.path.join(self.tmp, 'out.arf'), 1)
+        with h5py.File(self.base + '.kwik', 'r') as kwik, \
+                h5py.File(self.base + '.kwx', 'r') as kwx:
+            for shank in ('0', '1', '2'):
+                source = kwik['channel_groups'][shank]
+                spikes = exported['spikes_' + shank]
+                clusters = source['spikes/clusters/main'][:]
+                np.testing.assert_array_equal(
+                    spikes['start'], source['spikes/time_samples'][:])
+                np.testing.assert_array_equal(spikes['cluster'], clusters)
+                # make_kwik puts cluster c in group c % 4
+                np.testing.assert_array_equal(spikes['group'], clusters % 4)
+                np.testing.assert_array_equal(
+                    exported['waves_' + shank],
+                    kwx['channel_groups'][shank]['waveforms_filtered'][:])
+                table = exported['clusters_' + shank]
+                np.testing.assert_array_equal(table['cluster'], np.arange(6))
+                np.testing.assert_array_equal(
+                    table['n_spikes'], np.bincount(clusters, minlength=6))
+        self.assertEqual(len(exported['geometry']), 12)
+
+    def test_small_blocks(self):
+        exported = self.export(os.path.join(self.tmp, 'out.arf'), 1)
+        with h5py.File(self.base + '.kwik', 'r') as kwik, \
+                h5py.File(self.base + '.kwx', 'r') as kwx, \
+                h5py.File(os.path.join(self.tmp, 'blocks.h5'), 'w') as out:
+            mergekwik2contarf.export_shank(kwik['channel_groups']['1'],
+                                           kwx['channel_groups']['1'], out,
+                                           30000., block_rows=300)
+            for name in ('spikes_1', 'waves_1', 'clusters_1',
+                         'cluster_groups_1'):
+                np.testing.assert_array_equal(out[name][()], exported[name])
+
+
+if __name__ == '__main__':
+    unittest.main()
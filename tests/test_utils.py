@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from utils import detect_pulses
+
+
+def reference_pulses(x, thr, window):
+    crossings = np.flatnonzero((x[:-1] < thr) & (x[1:] > thr))
+    return np.array([i + np.argmax(x[i:i + window]) for i in crossings],
+                    dtype=int)
+
+
+class TestDetectPulses(unittest.TestCase):
+
+    def test_pulses(self):
+        x = np.zeros(10000)
+        x[[1000, 5000, 9990]] = 5
+        x[5001] = 7
+        np.testing.assert_array_equal(detect_pulses(x, window=100),
+                                      [1000, 5001, 9990])
+
+    def test_noisy_channel(self):
+        # thousands of crossings per chunk are gathered in batches
+        x = np.random.RandomState(0).randn(50000)
+        expected = reference_pulses(x, 1, 300)
+        self.assertGreater(len(expected), 5000)
+        for chunk_size in (1000, 4096, 2**20):
+            np.testing.assert_array_equal(
+                detect_pulses(x, window=300, chunk_size=chunk_size), expected)
+
+    def test_window_longer_than_chunk(self):
+        x = np.random.RandomState(1).randn(5000)
+        np.testing.assert_array_equal(
+            detect_pulses(x, window=700, chunk_size=500),
+            reference_pulses(x, 1, 700))
+
+
+if __name__ == '__main__':
+    unittest.main()
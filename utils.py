@@ -1,26 +1,76 @@
 import h5py
 import numpy as np
 from matplotlib import pyplot as plt
+from probe_model import load_probe, geometry_dict
+from arf_index import get_index, index_datasets, index_samplerate
 
 
-def detect_pulse(x):
+PULSE_CHUNK_SIZE = 2**20
+
+
+def detect_pulse(x, chunk_size=PULSE_CHUNK_SIZE):
     '''returns the index of the pulse, assumes single pulse'''
-    dx = np.diff(x)
-    # +1 is to compensate for diff's method of differentiation
-    return np.argmax(dx) + 1
+    best, best_idx = -np.inf, 0
+    # chunks overlap by one sample so no difference is missed
+    for start in range(0, max(len(x) - 1, 1), chunk_size):
+        dx = np.diff(x[start:start + chunk_size + 1])
+        if len(dx) and dx.max() > best:
+            best = dx.max()
+            # +1 is to compensate for diff's method of differentiation
+            best_idx = start + np.argmax(dx) + 1
+    return best_idx
+
+
+def detect_pulses(x, thr=1, window=2000, refractory=0,
+                  chunk_size=PULSE_CHUNK_SIZE):
+    '''returns the indices of pulses in X, a dataset or array.
+    A pulse starts where X rises above THR, and its index is the maximum of X
+    in the WINDOW samples following the crossing. Crossings less than
+    REFRACTORY samples after the previous crossing are ignored.
+    X is read in chunks of CHUNK_SIZE samples plus WINDOW samples overlap,
+    and the windows following at most CHUNK_SIZE // WINDOW crossings are
+    gathered at once'''
+    n = len(x)
+    peaks = []
+    last_crossing = -np.inf
+    for start in range(0, max(n - 1, 0), chunk_size):
+        stop = min(n - 1, start + chunk_size)
+        data = np.asarray(x[start:min(n, stop + window)], dtype=float)
+        crossings = np.flatnonzero((data[:stop - start] < thr) &
+                                   (data[1:stop - start + 1] > thr))
+        if refractory and len(crossings):
+            gaps = np.diff(np.concatenate(([last_crossing - start], crossings)))
+            last_crossing = start + crossings[-1]
+            crossings = crossings[gaps >= refractory]
+        if not len(crossings):
+            continue
+        # windows running past the end of X are padded with -inf
+        padded = np.concatenate((data, np.full(window, -np.inf)))
+        step = max(1, chunk_size // window)
+        for i in range(0, len(crossings), step):
+            batch = crossings[i:i + step]
+            windows = padded[batch[:, None] + np.arange(window)]
+            peaks.append(start + batch + np.argmax(windows, axis=1))
+    if not peaks:
+        return np.zeros(0, dtype=int)
+    return np.concatenate(peaks)
 
 
 def arf_entries(arf_file):
-    entries = [x for x in arf_file.values() if type(x) == h5py.Group]
-    return sorted(entries, key=repr)
+    return [arf_file[name] for name in get_index(arf_file)['entries']]
 
 
 def entry_time_series_datasets(entry):
-    datasets = [x for x in entry.values()
-                if type(x) == h5py.Dataset
-                and 'datatype' in x.attrs.keys()
-                and x.attrs['datatype'] < 1000]
-    return sorted(datasets, key=repr)
+    if entry.parent.name != '/':
+        # not an arf entry, so not in the index
+        datasets = [x for x in entry.values()
+                    if type(x) == h5py.Dataset
+                    and 'datatype' in x.attrs.keys()
+                    and x.attrs['datatype'] < 1000]
+        return sorted(datasets, key=repr)
+    index = get_index(entry.file)
+    return [entry[name] for name in
+            index_datasets(index, entry.name[1:], time_series=True)]
 
 
 def jstim_log_sequence(stimlog):
@@ -31,9 +81,7 @@ def jstim_log_sequence(stimlog):
 def geometry(probe_fname):
     """returns the geometry of a probe,
     as a dictionary"""
-    geometry = None             # to be redefined by probe_fname
-    exec(open(probe_fname, 'r').read())
-    return geometry
+    return geometry_dict(load_probe(probe_fname))
 
 
 def plot_song(song, xstart, xstop):
@@ -49,14 +97,10 @@ def arf_samplerate(arf_filename):
     else:
         arf_file = h5py.File(arf_filename, 'r')
         open_flag = True
-    for group in arf_file.values():
-        for dataset in group.values():
-            if 'datatype' in dataset.attrs \
-               and dataset.attrs['datatype'] < 1000 \
-               and 'sampling_rate' in dataset.attrs:
-                sampling_rate = dataset.attrs['sampling_rate']
-                print(sampling_rate)
-                if open_flag:
-                    arf_file.flush()
-                    arf_file.close()
-                return sampling_rate
+    sampling_rate = index_samplerate(get_index(arf_file))
+    if open_flag:
+        arf_file.flush()
+        arf_file.close()
+    if sampling_rate is not None:
+        print(sampling_rate)
+        return sampling_rate